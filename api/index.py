@@ -3,6 +3,9 @@ from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta
 import os
 import json
+import hmac
+import hashlib
+import base64
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 
@@ -49,6 +52,35 @@ POSITION_OPTIONS = [
     '資訊長'
 ]
 
+# 權限位元：與 app.py 相同，成員的 permissions 欄位是所擁有權限位元的 OR
+PERMISSION_BITS = {
+    'add_events': 1 << 0,
+    'edit_events': 1 << 1,
+    'delete_events': 1 << 2,
+    'manage_users': 1 << 3
+}
+ALL_PERMISSIONS = sum(PERMISSION_BITS.values())
+# 表單沿用原本的欄位名稱
+PERMISSION_FIELDS = {f'can_{name}': bit for name, bit in PERMISSION_BITS.items()}
+
+# 職級預設權限（管理頁面的選單使用）
+ROLE_PRESETS = {
+    '區董顧': PERMISSION_BITS['add_events'] | PERMISSION_BITS['edit_events'],
+    '執行董顧': PERMISSION_BITS['add_events'] | PERMISSION_BITS['edit_events'],
+    '董顧': PERMISSION_BITS['add_events'],
+    '主席': ALL_PERMISSIONS,
+    '副主席': PERMISSION_BITS['add_events'] | PERMISSION_BITS['edit_events'] | PERMISSION_BITS['delete_events'],
+    '教育組長': PERMISSION_BITS['add_events'] | PERMISSION_BITS['edit_events'],
+    '資訊長': ALL_PERMISSIONS
+}
+
+def permission_mask(fields):
+    """由勾選的權限欄位名稱組成位元遮罩"""
+    mask = 0
+    for field in fields:
+        mask |= PERMISSION_FIELDS.get(field, 0)
+    return mask
+
 # 權限檢查輔助函數
 def has_permission(permission):
     """檢查當前用戶是否有指定權限"""
@@ -60,20 +92,7 @@ def has_permission(permission):
         return False
     
     # 管理員擁有所有權限
-    if user.is_admin:
-        return True
-    
-    # 檢查特定權限
-    if permission == 'add_events':
-        return user.can_add_events
-    elif permission == 'edit_events':
-        return user.can_edit_events
-    elif permission == 'delete_events':
-        return user.can_delete_events
-    elif permission == 'manage_users':
-        return user.can_manage_users
-    
-    return False
+    return user.is_admin or bool(user.permissions & PERMISSION_BITS.get(permission, 0))
 
 # 數據模型
 class User(db.Model):
@@ -87,10 +106,7 @@ class User(db.Model):
     avatar = db.Column(db.String(200))  # 新增：頭像檔案路徑
     position = db.Column(db.String(50))  # 新增：職級欄位
     bio = db.Column(db.Text)  # 新增：自介欄位
-    can_add_events = db.Column(db.Boolean, default=False)  # 新增：可以新增活動
-    can_edit_events = db.Column(db.Boolean, default=False)  # 新增：可以編輯活動
-    can_delete_events = db.Column(db.Boolean, default=False)  # 新增：可以刪除活動
-    can_manage_users = db.Column(db.Boolean, default=False)  # 新增：可以管理用戶
+    permissions = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # 新增：權限位元遮罩（PERMISSION_BITS）
     is_admin = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -396,6 +412,7 @@ def event_detail(event_id):
     return render_template('event_detail.html', 
                          event=event, 
                          user_checkin=user_checkin,
+                         now=datetime.now(),
                          has_permission=has_permission)
 
 @app.route('/event/<int:event_id>/checkin', methods=['POST'])
@@ -432,6 +449,151 @@ def event_checkin(event_id):
     
     return jsonify({'success': True, 'message': '活動簽到成功！'})
 
+@app.route('/event/<int:event_id>/register', methods=['POST'])
+def event_register(event_id):
+    """報名活動；額滿時列入候補"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+    
+    event = db.session.get(Event, event_id)
+    if not event:
+        return jsonify({'success': False, 'message': '活動不存在！'})
+    
+    if event.end_time < datetime.now():
+        return jsonify({'success': False, 'message': '活動已結束，無法報名！'})
+    
+    registration = EventRegistration.query.filter_by(event_id=event_id, user_id=session['user_id']).first()
+    if registration and registration.status != 'cancelled':
+        message = '已經報名過此活動' if registration.status == 'registered' else '已在候補名單中'
+        return jsonify({'success': False, 'message': message, 'status': registration.status})
+    
+    registered = EventRegistration.query.filter_by(event_id=event_id, status='registered').count()
+    status = 'registered' if not event.max_participants or registered < event.max_participants else 'waitlisted'
+    if registration:
+        registration.status = status
+        registration.registered_at = datetime.utcnow()
+    else:
+        db.session.add(EventRegistration(event_id=event_id, user_id=session['user_id'], status=status))
+    db.session.commit()
+    
+    message = '報名成功！' if status == 'registered' else '活動已額滿，已列入候補名單'
+    return jsonify({'success': True, 'message': message, 'status': status})
+
+@app.route('/event/<int:event_id>/cancel', methods=['POST'])
+def event_cancel_registration(event_id):
+    """取消報名；釋出的名額由最早的候補成員遞補"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+    
+    registration = EventRegistration.query.filter(
+        EventRegistration.event_id == event_id,
+        EventRegistration.user_id == session['user_id'],
+        EventRegistration.status.in_(['registered', 'waitlisted'])
+    ).first()
+    if not registration:
+        return jsonify({'success': False, 'message': '尚未報名此活動'})
+    
+    promoted = None
+    if registration.status == 'registered':
+        promoted = EventRegistration.query.filter_by(event_id=event_id, status='waitlisted').order_by(
+            EventRegistration.registered_at, EventRegistration.id
+        ).first()
+        if promoted:
+            promoted.status = 'registered'
+    registration.status = 'cancelled'
+    db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'message': '已取消報名',
+        'promoted_user_id': promoted.user_id if promoted else None
+    })
+
+@app.route('/checkin-sw.js')
+def checkin_service_worker():
+    """離線簽到 Service Worker，從根路徑提供以涵蓋所有活動頁面"""
+    response = app.send_static_file('js/checkin-sw.js')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# QR 簽到憑證：與 app.py 相同的格式與簽章，這裡只有預設分會
+QR_TOKEN_EARLY = timedelta(minutes=30)  # 活動開始前多久可以掃碼簽到
+
+def qr_signature(payload):
+    """以 HMAC-SHA256 簽署 QR 憑證內容（截斷為 96 位元以縮短 QR 碼）"""
+    secret = app.config.get('CHECKIN_QR_SECRET') or app.config['SECRET_KEY']
+    digest = hmac.new(secret.encode(), b'checkin-qr:' + payload.encode(), hashlib.sha256).digest()[:12]
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def make_checkin_token(event, user_id):
+    """產生綁定活動、成員與簽到時間窗的 QR 憑證"""
+    not_before = int((event.start_time - QR_TOKEN_EARLY).timestamp())
+    expires = int(event.end_time.timestamp())
+    payload = f'{event.id}.{user_id}.{not_before}.{expires}'
+    return f'{payload}.{qr_signature(payload)}'
+
+def verify_checkin_token(token, now=None):
+    """驗證 QR 憑證的簽章與時間窗；回傳 (event_id, user_id, 錯誤訊息)"""
+    try:
+        payload, signature = token.rsplit('.', 1)
+        event_id, user_id, not_before, expires = (int(part) for part in payload.split('.'))
+    except (AttributeError, ValueError):
+        return None, None, '無效的簽到憑證'
+
+    if not hmac.compare_digest(signature, qr_signature(payload)):
+        return None, None, '無效的簽到憑證'
+
+    timestamp = (now or datetime.now()).timestamp()
+    if timestamp < not_before:
+        return event_id, user_id, '活動尚未開始，無法簽到！'
+    if timestamp > expires:
+        return event_id, user_id, '活動已結束，無法簽到！'
+    return event_id, user_id, None
+
+@app.route('/admin/events/<int:event_id>/qr_tokens')
+def event_qr_tokens(event_id):
+    """批次產生活動所有成員的 QR 簽到憑證"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+
+    if not has_permission('edit_events'):
+        return jsonify({'success': False, 'message': '權限不足'})
+
+    event = db.session.get(Event, event_id)
+    if not event:
+        return jsonify({'success': False, 'message': '活動不存在'})
+
+    # 如果不是管理員，只能產生自己發起的活動憑證
+    if not session.get('is_admin') and event.organizer_id != session['user_id']:
+        return jsonify({'success': False, 'message': '只能產生自己發起的活動憑證'})
+
+    members = db.session.query(User.id, User.name).order_by(User.id).all()
+    tokens = [
+        {'user_id': user_id, 'name': name, 'token': make_checkin_token(event, user_id)}
+        for user_id, name in members
+    ]
+
+    if request.args.get('format') == 'json':
+        return jsonify({'success': True, 'event_id': event.id, 'tokens': tokens})
+
+    return render_template('event_qr_tokens.html', event=event, tokens=tokens)
+
+@app.route('/api/checkin/scan', methods=['POST'])
+def scan_checkin():
+    """掃描 QR 憑證簽到（單筆，以伺服器時間為準）"""
+    payload = request.get_json(silent=True) or {}
+    event_id, user_id, message = verify_checkin_token(payload.get('token'))
+    if message:
+        return jsonify({'success': False, 'message': message, 'event_id': event_id, 'user_id': user_id})
+
+    # 檢查是否已簽到
+    if CheckIn.query.filter_by(user_id=user_id, event_id=event_id).first():
+        return jsonify({'success': False, 'message': '該人員已經在此活動簽到過了！', 'event_id': event_id, 'user_id': user_id})
+
+    db.session.add(CheckIn(user_id=user_id, event_id=event_id, notes='QR簽到'))
+    db.session.commit()
+    return jsonify({'success': True, 'message': '活動簽到成功！', 'event_id': event_id, 'user_id': user_id})
+
 @app.route('/admin')
 def admin():
     if 'user_id' not in session or not session.get('is_admin'):
@@ -454,7 +616,10 @@ def admin():
                          total_events=total_events,
                          total_checkins=total_checkins,
                          recent_events=recent_events,
-                         recent_checkins=recent_checkins)
+                         recent_checkins=recent_checkins,
+                         has_permission=has_permission,
+                         permission_fields=PERMISSION_FIELDS,
+                         role_presets=ROLE_PRESETS)
 
 @app.route('/admin/users')
 def admin_users():
@@ -485,10 +650,7 @@ def get_user_detail(user_id):
             'line_id': user.line_id,
             'position': user.position,
             'bio': user.bio,
-            'can_add_events': user.can_add_events,
-            'can_edit_events': user.can_edit_events,
-            'can_delete_events': user.can_delete_events,
-            'can_manage_users': user.can_manage_users,
+            'permissions': user.permissions,
             'is_admin': user.is_admin
         }
     })
@@ -662,10 +824,7 @@ def add_user():
             phone=phone,
             line_id=line_id,
             position=position,
-            can_add_events=request.form.get('can_add_events') == 'on',
-            can_edit_events=request.form.get('can_edit_events') == 'on',
-            can_delete_events=request.form.get('can_delete_events') == 'on',
-            can_manage_users=request.form.get('can_manage_users') == 'on',
+            permissions=permission_mask(request.form),
             is_admin=request.form.get('is_admin') == 'on'
         )
         
@@ -694,10 +853,7 @@ def edit_user(user_id):
         user.line_id = request.form.get('line_id', '')
         user.position = request.form.get('position', '')
         user.bio = request.form.get('bio', '')
-        user.can_add_events = request.form.get('can_add_events') == 'on'
-        user.can_edit_events = request.form.get('can_edit_events') == 'on'
-        user.can_delete_events = request.form.get('can_delete_events') == 'on'
-        user.can_manage_users = request.form.get('can_manage_users') == 'on'
+        user.permissions = permission_mask(request.form)
         user.is_admin = request.form.get('is_admin') == 'on'
         
         # 如果提供了新密碼，則更新密碼
@@ -759,13 +915,13 @@ def upload_avatar():
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             filename = f"{session['user_id']}_{timestamp}_{filename}"
             
-                    # 確保 avatars 目錄存在
-        avatar_dir = os.path.join(app.static_folder, 'uploads', 'avatars')
-        os.makedirs(avatar_dir, exist_ok=True)
-        
-        # 保存檔案
-        file_path = os.path.join(avatar_dir, filename)
-        file.save(file_path)
+            # 確保 avatars 目錄存在
+            avatar_dir = os.path.join(app.static_folder, 'uploads', 'avatars')
+            os.makedirs(avatar_dir, exist_ok=True)
+            
+            # 保存檔案
+            file_path = os.path.join(avatar_dir, filename)
+            file.save(file_path)
             
             # 更新用戶資料庫
             user = db.session.get(User, session['user_id'])
@@ -820,10 +976,7 @@ with app.app_context():
             name='001/管理員/系統管理員',
             email='admin@example.com',
             is_admin=True,
-            can_add_events=True,
-            can_edit_events=True,
-            can_delete_events=True,
-            can_manage_users=True
+            permissions=ALL_PERMISSIONS
         )
         db.session.add(admin)
         db.session.commit()
@@ -1,8 +1,42 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, render_template_string
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context, send_file, has_request_context
+from flask.globals import app_ctx
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import inspect, DDL, event as sa_event
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime, date, time, timedelta, timezone
+from dataclasses import dataclass, fields
+from typing import NamedTuple
+from contextlib import contextmanager
+import contextvars
+import functools
 import os
+import re
 import json
+import time as time_module
+import hmac
+import bisect
+import calendar
+import base64
+import hashlib
+import csv
+import io
+import zipfile
+from xml.sax.saxutils import escape as xml_escape
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import fcntl
+import gc
+import atexit
+from collections import deque
+import socket
+import smtplib
+import urllib.request
+from email.message import EmailMessage
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 
@@ -17,6 +51,38 @@ POSITION_OPTIONS = [
     '資訊長'
 ]
 
+# 靜態查詢表：職級排序與權限位元，匯入時建立一次
+POSITION_RANK = {position: rank for rank, position in enumerate(POSITION_OPTIONS)}
+
+# 權限位元：成員的 permissions 欄位是所擁有權限位元的 OR，檢查只需一次位元運算
+PERMISSION_BITS = {
+    'add_events': 1 << 0,
+    'edit_events': 1 << 1,
+    'delete_events': 1 << 2,
+    'manage_users': 1 << 3
+}
+ALL_PERMISSIONS = sum(PERMISSION_BITS.values())
+# 表單與匯入檔沿用原本的欄位名稱
+PERMISSION_FIELDS = {f'can_{name}': bit for name, bit in PERMISSION_BITS.items()}
+
+# 職級預設權限，授予職級時加到成員原有的權限上
+ROLE_PRESETS = {
+    '區董顧': PERMISSION_BITS['add_events'] | PERMISSION_BITS['edit_events'],
+    '執行董顧': PERMISSION_BITS['add_events'] | PERMISSION_BITS['edit_events'],
+    '董顧': PERMISSION_BITS['add_events'],
+    '主席': ALL_PERMISSIONS,
+    '副主席': PERMISSION_BITS['add_events'] | PERMISSION_BITS['edit_events'] | PERMISSION_BITS['delete_events'],
+    '教育組長': PERMISSION_BITS['add_events'] | PERMISSION_BITS['edit_events'],
+    '資訊長': ALL_PERMISSIONS
+}
+
+def permission_mask(fields):
+    """由勾選的權限欄位名稱組成位元遮罩"""
+    mask = 0
+    for field in fields:
+        mask |= PERMISSION_FIELDS.get(field, 0)
+    return mask
+
 # 權限檢查輔助函數
 def has_permission(permission):
     """檢查當前用戶是否有指定權限"""
@@ -28,25 +94,54 @@ def has_permission(permission):
         return False
     
     # 管理員擁有所有權限
-    if user.is_admin:
-        return True
-    
-    # 檢查特定權限
-    if permission == 'add_events':
-        return user.can_add_events
-    elif permission == 'edit_events':
-        return user.can_edit_events
-    elif permission == 'delete_events':
-        return user.can_delete_events
-    elif permission == 'manage_users':
-        return user.can_manage_users
-    
-    return False
+    return user.is_admin or bool(user.permissions & PERMISSION_BITS.get(permission, 0))
 
 # 創建 Flask 應用
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 
+# 模板編譯結果寫入磁碟快取，重啟或新 worker 載入模板時不需重新編譯
+JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR') or os.path.join(app.instance_path, 'jinja_cache')
+try:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(JINJA_CACHE_DIR)}
+except OSError:
+    # 唯讀檔案系統時改用系統暫存目錄
+    app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache()}
+
+# JSON 輸出：有安裝 orjson 時使用，dataclass 與 datetime 都由 C 實作直接序列化
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_OMIT_MICROSECONDS) if orjson else 0
+
+def json_default(value):
+    # 日期時間一律輸出 ISO 格式（不含微秒），與 orjson 一致
+    if isinstance(value, datetime):
+        return value.isoformat(timespec='seconds')
+    if isinstance(value, date):
+        return value.isoformat()
+    return DefaultJSONProvider.default(value)
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify 使用的序列化層，未安裝 orjson 時退回標準庫 json"""
+    default = staticmethod(json_default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=json_default, option=ORJSON_OPTIONS).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=json_default, option=ORJSON_OPTIONS), mimetype=self.mimetype)
+
+app.json = FastJSONProvider(app)
+
 # 根據環境設置數據庫路徑
 if os.environ.get('FLASK_ENV') == 'production':
     # 生產環境使用絕對路徑
@@ -77,34 +172,14 @@ def test():
     })
 
 @app.route('/')
-def index_simple():
-    """簡化的首頁，不依賴數據庫"""
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>簽到系統</title>
-        <meta charset="utf-8">
-        <style>
-            body { font-family: Arial, sans-serif; margin: 40px; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; }
-            .container { max-width: 600px; margin: 0 auto; text-align: center; }
-            .btn { padding: 15px 30px; margin: 10px; text-decoration: none; color: white; background: rgba(255,255,255,0.2); border-radius: 10px; display: inline-block; }
-            .btn:hover { background: rgba(255,255,255,0.3); }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>🎉 簽到系統</h1>
-            <p>您的網站已經成功部署到 Render！</p>
-            <p>環境：{{ env.get("FLASK_ENV", "development") }}</p>
-            <div>
-                <a href="/test" class="btn">測試 API</a>
-                <a href="/health" class="btn">健康檢查</a>
-            </div>
-        </div>
-    </body>
-    </html>
-    ''', env=os.environ)
+def index():
+    """首頁（部署狀態頁），不依賴數據庫；base.html 與登入頁以 url_for('index') 連到這裡"""
+    return render_template('status/index.html', env=os.environ)
+
+def precompile_templates():
+    """啟動時編譯 templates/ 下所有模板，第一個請求不必等待編譯"""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -113,13 +188,121 @@ def allowed_file(filename):
 def save_avatar(file, user_id):
     if file and allowed_file(file.filename):
         # 生成安全的檔案名
-        filename = secure_filename(f"avatar_{user_id}_{int(datetime.now().timestamp())}.{file.filename.rsplit('.', 1)[1].lower()}")
+        filename = secure_filename(chapter_scoped(f"avatar_{user_id}_{int(datetime.now().timestamp())}.{file.filename.rsplit('.', 1)[1].lower()}", '_'))
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         return f"uploads/avatars/{filename}"
     return None
 
-db = SQLAlchemy(app)
+# 分會設定
+# CHAPTERS="main:華地產白金分會,taipei:台北分會"，第一個是預設分會並沿用主資料庫 checkin.db，
+# 其他分會各自使用主資料庫旁的 chapters/<代號>.db。成員、活動、簽到等資料都存在所屬分會的資料庫檔，
+# 各分會的寫入鎖與負載互不影響；目前分會由登入時的選擇決定，查詢時由 ChapterSession 選擇資料庫。
+def parse_chapters(value):
+    chapters = {}
+    for item in (value or '').split(','):
+        slug, _, name = item.strip().partition(':')
+        if not slug:
+            continue
+        if not re.fullmatch(r'[a-z0-9_-]+', slug):
+            raise RuntimeError(f'分會代號只能使用小寫英數字、底線與連字號：{slug}')
+        chapters[slug] = name or slug
+    return chapters or {'main': '華地產白金分會'}
+
+CHAPTERS = parse_chapters(os.environ.get('CHAPTERS'))
+DEFAULT_CHAPTER = next(iter(CHAPTERS))
+REGION_FANOUT_WORKERS = 8  # 跨分會彙總時同時查詢的分會數
+current_chapter_var = contextvars.ContextVar('chapter', default=DEFAULT_CHAPTER)
+
+def current_chapter():
+    return current_chapter_var.get()
+
+def chapter_bind_key(slug):
+    return None if slug == DEFAULT_CHAPTER else f'chapter:{slug}'
+
+def database_folder():
+    """主資料庫檔所在的資料夾"""
+    main_path = app.config['SQLALCHEMY_DATABASE_URI'].removeprefix('sqlite:///')
+    if not os.path.isabs(main_path):
+        main_path = os.path.join(app.instance_path, main_path)
+    return os.path.dirname(main_path)
+
+def chapter_database_uri(slug):
+    """其他分會的資料庫檔放在主資料庫旁的 chapters/ 資料夾"""
+    folder = os.path.join(database_folder(), 'chapters')
+    os.makedirs(folder, exist_ok=True)
+    return f"sqlite:///{os.path.join(folder, f'{slug}.db')}"
+
+def chapter_scoped(text, separator=':'):
+    """簽章、檔名等需要區分分會的字串；預設分會保持原樣，已發出的憑證、網址與檔案仍然有效"""
+    chapter = current_chapter()
+    return text if chapter == DEFAULT_CHAPTER else f'{chapter}{separator}{text}'
+
+app.config['SQLALCHEMY_BINDS'] = {
+    chapter_bind_key(slug): chapter_database_uri(slug) for slug in CHAPTERS if slug != DEFAULT_CHAPTER
+}
+
+class ChapterSession(FlaskSQLAlchemySession):
+    """依目前分會選擇資料庫連線"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        key = chapter_bind_key(current_chapter())
+        if bind is None and key is not None:
+            return self._db.engines[key]
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+def session_scope():
+    # 同一個 app context 切換分會時各自使用獨立的 session，識別對應表不會混用不同分會的同一個 ID
+    return (id(app_ctx._get_current_object()), current_chapter())
+
+db = SQLAlchemy(app, session_options={'class_': ChapterSession, 'scopefunc': session_scope})
+
+def chapter_engine(slug=None):
+    return db.engines[chapter_bind_key(slug or current_chapter())]
+
+@contextmanager
+def chapter_context(slug):
+    """在指定分會中執行；離開時釋放該分會的 session"""
+    token = current_chapter_var.set(slug)
+    try:
+        yield
+    finally:
+        db.session.remove()
+        current_chapter_var.reset(token)
+
+def fan_out(func):
+    """對每個分會平行執行 func()，各自使用獨立的 app context 與連線；回傳 {分會代號: 結果}"""
+    def run(slug):
+        with app.app_context(), chapter_context(slug):
+            return slug, func()
+    with ThreadPoolExecutor(max_workers=min(len(CHAPTERS), REGION_FANOUT_WORKERS)) as executor:
+        return dict(executor.map(run, CHAPTERS))
+
+@app.before_request
+def select_chapter():
+    chapter = session.get('chapter', DEFAULT_CHAPTER)
+    if chapter not in CHAPTERS:
+        # 分會已從設定中移除，要求重新登入
+        session.clear()
+        chapter = DEFAULT_CHAPTER
+    current_chapter_var.set(chapter)
+
+@app.teardown_appcontext
+def release_chapter_sessions(exception=None):
+    # Flask-SQLAlchemy 只會釋放目前範圍的 session，請求中途切換過分會（登入、註冊）時逐一釋放
+    for slug in CHAPTERS:
+        with chapter_context(slug):
+            pass
+
+@app.context_processor
+def inject_chapter():
+    return {
+        'chapters': CHAPTERS,
+        'default_chapter': DEFAULT_CHAPTER,
+        'current_chapter': current_chapter(),
+        'current_chapter_name': CHAPTERS[current_chapter()]
+    }
+
 
 # 數據模型
 class User(db.Model):
@@ -133,42 +316,382 @@ class User(db.Model):
     avatar = db.Column(db.String(200))  # 新增：頭像檔案路徑
     position = db.Column(db.String(50))  # 新增：職級欄位
     bio = db.Column(db.Text)  # 新增：自介欄位
-    can_add_events = db.Column(db.Boolean, default=False)  # 新增：可以新增活動
-    can_edit_events = db.Column(db.Boolean, default=False)  # 新增：可以編輯活動
-    can_delete_events = db.Column(db.Boolean, default=False)  # 新增：可以刪除活動
-    can_manage_users = db.Column(db.Boolean, default=False)  # 新增：可以管理用戶
+    permissions = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # 新增：權限位元遮罩（PERMISSION_BITS）
     is_admin = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class CheckIn(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    check_in_time = db.Column(db.DateTime, default=datetime.utcnow)
+    check_in_time = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     check_out_time = db.Column(db.DateTime)
     location = db.Column(db.String(200))
     notes = db.Column(db.Text)
     status = db.Column(db.String(20), default='checked_in')  # checked_in, checked_out
     event_id = db.Column(db.Integer, db.ForeignKey('event.id'))  # 新增：關聯活動
 
+    # 同一成員在同一活動只能簽到一次（每日簽到的 event_id 為 NULL，不受限制）
+    __table_args__ = (
+        db.Index('ix_check_in_user_event', 'user_id', 'event_id', unique=True),
+        db.Index('ix_check_in_event', 'event_id'),  # 新增：依活動查詢簽到
+    )
+
+class ArchivedCheckIn(db.Model):
+    """已封存的歷史簽到，存放在附加的 archive 資料庫檔，欄位與 CheckIn 相同"""
+    __tablename__ = 'check_in'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    check_in_time = db.Column(db.DateTime)
+    check_out_time = db.Column(db.DateTime)
+    location = db.Column(db.String(200))
+    notes = db.Column(db.Text)
+    status = db.Column(db.String(20))
+    event_id = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index('ix_archive_check_in_user_event', 'user_id', 'event_id'),
+        db.Index('ix_archive_check_in_event', 'event_id'),
+        {'schema': 'archive'},
+    )
+
 class Event(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
-    start_time = db.Column(db.DateTime, nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False, index=True)
     end_time = db.Column(db.DateTime, nullable=False)
     location = db.Column(db.String(50), nullable=False)
     organizer_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     max_participants = db.Column(db.Integer, default=0)  # 0表示無限制
+    series_id = db.Column(db.Integer, db.ForeignKey('event_series.id'), index=True)  # 新增：所屬重複活動
+    registered_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # 新增：已報名人數快取
+    attended_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # 新增：已簽到人數快取
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     organizer = db.relationship('User', backref='organized_events')
 
+class EventSeries(db.Model):
+    """重複活動規則，活動實例在滾動期間內批次產生"""
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.Text)
+    location = db.Column(db.String(50), nullable=False)
+    organizer_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    max_participants = db.Column(db.Integer, default=0)
+    first_start = db.Column(db.DateTime, nullable=False)  # 第一次活動的開始時間
+    duration_minutes = db.Column(db.Integer, nullable=False)
+    frequency = db.Column(db.String(20), nullable=False)  # weekly, biweekly, monthly
+    until = db.Column(db.Date)  # 重複結束日期，空值表示不限
+    exceptions = db.Column(db.Text, default='')  # 不舉辦的日期，以逗號分隔 YYYY-MM-DD
+    materialized_until = db.Column(db.DateTime, nullable=False)  # 已產生實例的時間上限
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def exception_dates(self):
+        return {value.strip() for value in (self.exceptions or '').split(',') if value.strip()}
+
 class EventRegistration(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     event_id = db.Column(db.Integer, db.ForeignKey('event.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     registered_at = db.Column(db.DateTime, default=datetime.utcnow)
-    status = db.Column(db.String(20), default='registered')  # registered, attended, cancelled
+    status = db.Column(db.String(20), default='registered')  # registered, waitlisted, attended, cancelled
+
+    __table_args__ = (
+        db.Index('ix_event_registration_event_user', 'event_id', 'user_id', unique=True),
+        db.Index('ix_event_registration_user', 'user_id', 'status'),  # 新增：依成員查詢報名
+    )
+
+class CheckInSyncOp(db.Model):
+    """離線簽到同步操作紀錄，以客戶端產生的冪等鍵去重"""
+    id = db.Column(db.Integer, primary_key=True)
+    idempotency_key = db.Column(db.String(64), unique=True, nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    checkin_id = db.Column(db.Integer, db.ForeignKey('check_in.id'))
+    client_time = db.Column(db.DateTime)  # 門口裝置記錄的簽到時間
+    result = db.Column(db.String(20), nullable=False)  # created, already_checked_in, rejected
+    synced_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    checkin = db.relationship('CheckIn')
+
+class CacheVersion(db.Model):
+    """快取版本計數器，資料變動時在同一交易中遞增，各程序比對版本決定是否重建快取"""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+
+class Job(db.Model):
+    """資料庫中的背景作業佇列，由 worker.py 取出執行"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text)  # JSON 參數
+    status = db.Column(db.String(20), default='queued', nullable=False)  # queued, running, succeeded, failed
+    progress = db.Column(db.Integer, default=0, nullable=False)  # 0-100
+    message = db.Column(db.String(500))
+    result = db.Column(db.Text)  # JSON 結果
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    max_attempts = db.Column(db.Integer, default=3, nullable=False)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  # 重試退避後才可再執行
+    locked_at = db.Column(db.DateTime)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_job_status_run_after', 'status', 'run_after'),
+    )
+
+class Reminder(db.Model):
+    """活動提醒寄件匣：排程時一次寫入，由背景作業分批寄送"""
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    channel = db.Column(db.String(20), nullable=False)  # email, line
+    address = db.Column(db.String(120), nullable=False)  # 排程當下的 email 或 LINE ID
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, sent, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    last_error = db.Column(db.String(500))
+    sent_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_reminder_event_user_channel', 'event_id', 'user_id', 'channel', unique=True),
+        db.Index('ix_reminder_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+class AuditLog(db.Model):
+    """管理操作稽核紀錄，只新增不修改"""
+    id = db.Column(db.Integer, primary_key=True)
+    actor_id = db.Column(db.Integer)  # 不設外鍵，成員刪除後紀錄仍保留
+    actor_name = db.Column(db.String(100))
+    action = db.Column(db.String(50), nullable=False)  # 例如 user.edit、event.delete
+    target_type = db.Column(db.String(30))
+    target_id = db.Column(db.Integer)
+    changes = db.Column(db.Text)  # JSON：{欄位: [變更前, 變更後]}
+    ip = db.Column(db.String(45))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_audit_log_target', 'target_type', 'target_id', 'id'),
+        db.Index('ix_audit_log_actor', 'actor_id', 'id'),
+        db.Index('ix_audit_log_action', 'action', 'id'),
+    )
+
+class ArrivalCurve(db.Model):
+    """已結束活動的到場分布，活動結束後不再變動，計算一次後保存"""
+    event_id = db.Column(db.Integer, db.ForeignKey('event.id'), primary_key=True, autoincrement=False)
+    start_time = db.Column(db.DateTime, nullable=False)  # 計算時的活動開始時間，活動改期後重新計算
+    total = db.Column(db.Integer, nullable=False)  # 計算時的簽到人數，與 Event.attended_count 不符時重新計算
+    buckets = db.Column(db.Text, nullable=False)  # JSON：[[相對開始時間的分鐘, 人數], ...]
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SchemaMigration(db.Model):
+    """已套用的資料庫遷移版本"""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# 快取世代計數器
+# 每個範圍（成員、活動、簽到）各有一個計數器，資料變動時在同一交易中遞增。
+# 各 worker 的快取記下建立時的世代，讀取時比對目前世代即可判斷是否過期，不需要短 TTL。
+CACHE_SCOPES = {
+    'user': 'users',
+    'event': 'events',
+    'event_series': 'events',
+    'event_registration': 'events',
+    'check_in': 'checkins',  # 含歸檔資料庫的同名資料表
+}
+CACHE_BROKER_URL = os.environ.get('CACHE_BROKER_URL')  # 多主機部署時指向 cache_broker.py，例如 tcp://10.0.0.5:7400
+
+def bump_version(name, connection=None):
+    """遞增快取世代；在資料變動的同一交易中呼叫，提交後其他程序即會重建"""
+    statement = sqlite_insert(CacheVersion).values(name=name, version=1).on_conflict_do_update(
+        index_elements=['name'], set_={'version': CacheVersion.version + 1}
+    )
+    (connection or db.session).execute(statement)
+
+def database_generations():
+    """從 cache_version 讀取所有世代
+
+    PRAGMA data_version 只在其他連線提交後才會改變，不需讀取資料表；
+    數值相同時沿用這條連線上次讀到的世代。本連線自己的提交或回滾由引擎事件清除記錄。
+    """
+    connection = db.session.connection()
+    data_version = connection.exec_driver_sql('PRAGMA data_version').scalar()
+    memo = connection.info.get('cache_generations')
+    if memo and memo[0] == data_version:
+        return memo[1]
+    generations = dict(connection.execute(db.select(CacheVersion.name, CacheVersion.version)).all())
+    connection.info['cache_generations'] = (data_version, generations)
+    return generations
+
+def forget_generations(connection):
+    connection.info.pop('cache_generations', None)
+
+class CacheBroker:
+    """cache_broker.py 的用戶端：多主機時由它轉發世代，連不上時退回資料庫"""
+
+    def __init__(self, url, timeout=0.5):
+        host, _, port = url.removeprefix('tcp://').rpartition(':')
+        self.address = (host or '127.0.0.1', int(port))
+        self.timeout = timeout
+
+    def request(self, line):
+        with socket.create_connection(self.address, timeout=self.timeout) as sock:
+            sock.sendall(line.encode() + b'\n')
+            return sock.makefile('rb').readline()
+
+    def generations(self):
+        return json.loads(self.request('GET'))
+
+    def publish(self, scopes):
+        self.request('INCR ' + ' '.join(sorted(scopes)))
+
+cache_broker = CacheBroker(CACHE_BROKER_URL) if CACHE_BROKER_URL else None
+
+def cache_generations():
+    """目前分會所有範圍的世代，{範圍: 數值}"""
+    if cache_broker:
+        try:
+            generations = cache_broker.generations()
+            # 代理上的範圍名稱帶有分會代號（預設分會除外）
+            scoped = {scope: generations.get(chapter_scoped(scope), 0) for scope in set(CACHE_SCOPES.values())}
+            return {**scoped, 'epoch': generations.get('epoch')}
+        except (OSError, ValueError) as e:
+            print(f"無法連線快取代理，改用資料庫世代：{e}")
+    return database_generations()
+
+def cache_generation(*scopes):
+    """指定範圍的世代；快取代理的 epoch 一併納入，切換來源或代理重啟後不會誤判為相同"""
+    generations = cache_generations()
+    return (generations.get('epoch'),) + tuple(generations.get(scope, 0) for scope in scopes)
+
+def changed_scopes(objects):
+    return {CACHE_SCOPES[obj.__table__.name] for obj in objects if getattr(obj, '__table__', None) is not None and obj.__table__.name in CACHE_SCOPES}
+
+def record_scopes(session, scopes):
+    """遞增世代並記下範圍，提交後再通知快取代理"""
+    pending = session.info.setdefault('cache_scopes', set())
+    for scope in scopes - pending:
+        # 直接使用連線執行，避免在 flush 中再次觸發 autoflush
+        bump_version(scope, session.connection())
+    pending.update(scopes)
+
+@sa_event.listens_for(Session, 'before_flush')
+def track_object_changes(session, flush_context, instances):
+    """ORM 物件新增、修改、刪除時，隨同一次 flush 遞增對應範圍的世代"""
+    dirty = (obj for obj in session.dirty if session.is_modified(obj))
+    scopes = changed_scopes(session.new) | changed_scopes(session.deleted) | changed_scopes(dirty)
+    if scopes:
+        record_scopes(session, scopes)
+
+@sa_event.listens_for(Session, 'do_orm_execute')
+def track_bulk_changes(orm_execute_state):
+    """批次 INSERT / UPDATE / DELETE 不經過 flush，依目標資料表遞增世代"""
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    scope = CACHE_SCOPES.get(orm_execute_state.statement.table.name)
+    if scope:
+        record_scopes(orm_execute_state.session, {scope})
+
+@sa_event.listens_for(Session, 'after_commit')
+def publish_scopes(session):
+    scopes = session.info.pop('cache_scopes', None)
+    if scopes and cache_broker:
+        try:
+            cache_broker.publish({chapter_scoped(scope) for scope in scopes})
+        except OSError as e:
+            print(f"無法通知快取代理：{e}")
+
+@sa_event.listens_for(Session, 'after_rollback')
+def discard_scopes(session):
+    session.info.pop('cache_scopes', None)
+
+# 成員名錄快取
+class DirectoryEntry(NamedTuple):
+    id: int
+    name: str
+    position: str | None
+    avatar: str | None
+
+class MemberDirectory:
+    """成員名錄快照：依 ID 排序的不可變 tuple，建立後只讀，可安全地跨請求與執行緒共用"""
+    __slots__ = ('version', 'entries', 'by_id')
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.entries = tuple(DirectoryEntry(*row) for row in rows)
+        self.by_id = {entry.id: entry for entry in self.entries}
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, user_id):
+        return self.by_id.get(user_id)
+
+directory_cache = {}  # {分會代號: MemberDirectory}
+
+def member_directory():
+    """取得成員名錄；users 世代未變時直接使用快照，不查詢 user 資料表"""
+    version = cache_generation('users')
+    chapter = current_chapter()
+    snapshot = directory_cache.get(chapter)
+    if snapshot is None or snapshot.version != version:
+        rows = db.session.query(User.id, User.name, User.position, User.avatar).order_by(User.id).all()
+        snapshot = directory_cache[chapter] = MemberDirectory(version, rows)
+    return snapshot
+
+# 全文搜尋
+# FTS5 外部內容表只存索引，內容直接讀原資料表，由觸發器在同一交易中同步，不需要另外維護。
+# trigram 分詞以每三個字元為單位建立索引，中文不需斷詞即可搜尋任意片段，例如「編號/姓名/專業別」中的專業別；
+# 少於三個字的詞無法用索引比對，改以 LIKE 篩選。
+SEARCH_INDEXES = {
+    'event_search': (Event, ('title', 'description', 'location'), (10.0, 1.0, 3.0)),  # 欄位與 bm25 權重
+    'user_search': (User, ('name', 'position', 'bio'), (5.0, 3.0, 1.0)),
+}
+SEARCH_MAX_TERMS = 8
+
+def search_index_ddl(name):
+    """建立全文索引與同步觸發器的 SQL（可重複執行）"""
+    model, columns, _ = SEARCH_INDEXES[name]
+    table = model.__tablename__
+    names = ', '.join(columns)
+    new = ', '.join(f'new.{column}' for column in columns)
+    old = ', '.join(f'old.{column}' for column in columns)
+    delete = f"INSERT INTO {name}({name}, rowid, {names}) VALUES ('delete', old.id, {old});"
+    insert = f"INSERT INTO {name}(rowid, {names}) VALUES (new.id, {new});"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5({names}, content='{table}', content_rowid='id', tokenize='trigram')",
+        f'CREATE TRIGGER IF NOT EXISTS {name}_insert AFTER INSERT ON "{table}" BEGIN {insert} END',
+        f'CREATE TRIGGER IF NOT EXISTS {name}_delete AFTER DELETE ON "{table}" BEGIN {delete} END',
+        # 只有索引欄位變動時才更新索引，人數快取等欄位的 UPDATE 不受影響
+        f'CREATE TRIGGER IF NOT EXISTS {name}_update AFTER UPDATE OF {names} ON "{table}" BEGIN {delete} {insert} END',
+    ]
+
+# 新資料庫由 create_all 建立資料表時一併建立索引；既有資料庫由遷移建立
+for search_name, (search_model, _, _) in SEARCH_INDEXES.items():
+    for statement in search_index_ddl(search_name):
+        sa_event.listen(search_model.__table__, 'after_create', DDL(statement))
+
+def search_filter(query, name, text):
+    """依搜尋字串篩選並以相關度排序；所有詞都必須符合"""
+    model, columns, weights = SEARCH_INDEXES[name]
+    terms = text.split()[:SEARCH_MAX_TERMS]
+    indexed = [term for term in terms if len(term) >= 3]
+    if indexed:
+        index = db.table(name, db.column('rowid'))
+        match = ' AND '.join('"' + term.replace('"', '""') + '"' for term in indexed)
+        query = query.join(index, index.c.rowid == model.id).filter(
+            db.literal_column(name).op('MATCH')(match)
+        ).order_by(db.func.bm25(db.literal_column(name), *weights))
+    for term in terms:
+        if len(term) < 3:
+            pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            query = query.filter(db.or_(*(getattr(model, column).like(pattern, escape='\\') for column in columns)))
+    return query
 
 # 健康檢查路由
 @app.route('/health')
@@ -185,10 +708,17 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        chapter = request.form.get('chapter', DEFAULT_CHAPTER)
+        if chapter not in CHAPTERS:
+            flash('分會不存在！', 'error')
+            return render_template('login.html')
         
+        # 成員資料在所屬分會的資料庫
+        current_chapter_var.set(chapter)
         user = User.query.filter_by(username=username).first()
         
         if user and check_password_hash(user.password_hash, password):
+            session['chapter'] = chapter
             session['user_id'] = user.id
             session['username'] = user.username
             session['name'] = user.name
@@ -215,11 +745,17 @@ def register():
         email = request.form.get('email', '')
         phone = request.form.get('phone', '')
         line_id = request.form.get('line_id', '')
+        chapter = request.form.get('chapter', DEFAULT_CHAPTER)
         
         if not username or not password or not name:
             flash('請填寫所有必填欄位', 'error')
             return render_template('register.html')
         
+        if chapter not in CHAPTERS:
+            flash('分會不存在', 'error')
+            return render_template('register.html')
+        current_chapter_var.set(chapter)
+        
         # 檢查用戶名是否已存在
         if User.query.filter_by(username=username).first():
             flash('用戶名已存在', 'error')
@@ -311,29 +847,194 @@ def checkout():
     
     return jsonify({'success': True, 'message': '簽退成功！'})
 
+# 簽到冷熱分層：超過保存期限的簽到移到 archive 資料庫檔
+CHECKIN_ARCHIVE_DAYS = int(os.environ.get('CHECKIN_ARCHIVE_DAYS', 365))
+ARCHIVE_BATCH_SIZE = 5000
+CHECKIN_COLUMNS = ('id', 'user_id', 'check_in_time', 'check_out_time', 'location', 'notes', 'status', 'event_id')
+
+def attach_checkin_archive(dbapi_connection, connection_record, archive_path=None):
+    """每條連線都附加封存資料庫，預設放在資料庫檔旁，例如 checkin.db 對應 checkin_archive.db"""
+    cursor = dbapi_connection.cursor()
+    main_path = next((row[2] for row in cursor.execute('PRAGMA database_list') if row[1] == 'main'), '')
+    archive_path = archive_path or (f'{os.path.splitext(main_path)[0]}_archive.db' if main_path else '')
+    cursor.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+    cursor.close()
+
+def checkin_history():
+    """熱表與封存表的 UNION ALL，需要完整歷史的查詢改從這裡讀"""
+    hot = CheckIn.__table__
+    cold = ArchivedCheckIn.__table__
+    return db.union_all(
+        db.select(*(hot.c[name] for name in CHECKIN_COLUMNS)),
+        db.select(*(cold.c[name] for name in CHECKIN_COLUMNS))
+    ).subquery('checkin_history')
+
+def archive_checkins(days=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """把超過保存期限的簽到分批搬到封存表，回傳搬移筆數
+
+    只搬活動也已超過期限的簽到，近期活動的重複簽到檢查只需要查熱表；
+    Event.attended_count 不受影響，出席統計透過 checkin_history() 仍包含封存資料。
+    """
+    days = CHECKIN_ARCHIVE_DAYS if days is None else days
+    cutoff_utc = datetime.utcnow() - timedelta(days=days)
+    cutoff_local = datetime.now() - timedelta(days=days)
+    hot = CheckIn.__table__
+    candidates = db.select(hot.c.id).where(
+        hot.c.check_in_time < cutoff_utc,
+        db.or_(hot.c.event_id.is_(None), hot.c.event_id.in_(
+            db.select(Event.id).where(Event.start_time < cutoff_local)
+        ))
+    ).order_by(hot.c.id).limit(batch_size)
+
+    moved = 0
+    while True:
+        ids = db.session.execute(candidates).scalars().all()
+        if not ids:
+            break
+        db.session.execute(ArchivedCheckIn.__table__.insert().from_select(
+            CHECKIN_COLUMNS,
+            db.select(*(hot.c[name] for name in CHECKIN_COLUMNS)).where(hot.c.id.in_(ids))
+        ))
+        db.session.execute(hot.delete().where(hot.c.id.in_(ids)))
+        # 每批各自提交，避免長時間鎖住資料庫
+        db.session.commit()
+        moved += len(ids)
+    return moved
+
+# 出席率計算
+ATTENDANCE_PERIODS = ('month', 'quarter')
+attendance_cache = {}
+
+def attendance_stats(eligible, attended):
+    attended = min(attended, eligible)
+    return {
+        'eligible': eligible,
+        'attended': attended,
+        'missed': eligible - attended,
+        'rate': round(attended / eligible * 100, 1) if eligible else 0
+    }
+
+def joined_at_local(created_at):
+    """created_at 以 UTC 儲存，活動時間是本地時間，比較前先轉換"""
+    if not created_at:
+        return datetime.min
+    return created_at.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+def period_key(moment, period):
+    if period == 'quarter':
+        return f'{moment.year}-Q{(moment.month - 1) // 3 + 1}'
+    return moment.strftime('%Y-%m')
+
+def period_key_sql(column, period):
+    if period == 'quarter':
+        month = db.cast(db.func.strftime('%m', column), db.Integer)
+        return db.func.printf('%s-Q%d', db.func.strftime('%Y', column), (month + 2) / 3)
+    return db.func.strftime('%Y-%m', column)
+
+def compute_attendance(user_ids=None, period=None, now=None):
+    """一次計算多位成員的出席率，只計入成員加入後且已開始的活動
+
+    應出席場次以排序後的活動時間二分搜尋取得，出席場次由單一 GROUP BY 查詢取得，
+    成本與成員數 × 期間數成正比，不需要逐一成員查詢。
+    """
+    now = now or datetime.now()
+    members = db.session.query(User.id, User.name, User.position, User.created_at)
+    if user_ids is not None:
+        members = members.filter(User.id.in_(user_ids))
+
+    # 依期間分組的已開始活動時間（已排序）
+    buckets = {}
+    for (start,) in db.session.query(Event.start_time).filter(Event.start_time <= now).order_by(Event.start_time):
+        buckets.setdefault(period_key(start, period) if period else None, []).append(start)
+
+    # 成員加入時間轉成本地時間後，在 SQL 中過濾加入前的活動
+    offset_seconds = int(datetime.now().astimezone().utcoffset().total_seconds())
+    joined_sql = db.func.datetime(User.created_at, f'{offset_seconds:+d} seconds')
+    key_sql = period_key_sql(Event.start_time, period) if period else db.literal(None)
+    history = checkin_history()
+    attended_query = db.session.query(
+        history.c.user_id, key_sql, db.func.count(db.distinct(history.c.event_id))
+    ).join(Event, Event.id == history.c.event_id).join(User, User.id == history.c.user_id).filter(
+        Event.start_time <= now,
+        db.or_(User.created_at.is_(None), Event.start_time >= joined_sql)
+    )
+    if user_ids is not None:
+        attended_query = attended_query.filter(history.c.user_id.in_(user_ids))
+    attended = {(user_id, key): count for user_id, key, count in attended_query.group_by(history.c.user_id, key_sql)}
+
+    results = []
+    for user_id, name, position, created_at in members:
+        joined = joined_at_local(created_at)
+        total_eligible = total_attended = 0
+        periods = {}
+        for key, starts in buckets.items():
+            eligible = len(starts) - bisect.bisect_left(starts, joined)
+            count = attended.get((user_id, key), 0)
+            total_eligible += eligible
+            total_attended += min(count, eligible)
+            if period and eligible:
+                periods[key] = attendance_stats(eligible, count)
+
+        member = {'user_id': user_id, 'name': name, 'position': position}
+        member.update(attendance_stats(total_eligible, total_attended))
+        if period:
+            member['periods'] = dict(sorted(periods.items()))
+        results.append(member)
+    return results
+
+def next_event_start(now):
+    """下一場活動的開始時間；活動開始後應出席場次會增加，依時間計算的快取只到此時有效"""
+    return db.session.query(db.func.min(Event.start_time)).filter(Event.start_time > now).scalar()
+
+def cache_lookup(cache, key, generation, now):
+    """世代相同且尚未到期時回傳快取內容，否則回傳 None"""
+    entry = cache.get(key)
+    if entry and entry[0] == generation and (entry[1] is None or now < entry[1]):
+        return entry[2]
+    return None
+
+def cache_store(cache, key, generation, valid_until, value):
+    cache[key] = (generation, valid_until, value)
+    return value
+
+def cached_attendance(period=None):
+    """全體成員出席率，簽到、活動或成員世代未變且沒有新活動開始時，直接使用上次的計算結果"""
+    now = datetime.now()
+    generation = cache_generation('users', 'events', 'checkins')
+    key = (current_chapter(), period)
+    results = cache_lookup(attendance_cache, key, generation, now)
+    if results is None:
+        results = cache_store(attendance_cache, key, generation, next_event_start(now),
+                              compute_attendance(period=period, now=now))
+    return results
+
+def member_attendance(user_id):
+    results = compute_attendance(user_ids=[user_id])
+    return results[0] if results else attendance_stats(0, 0)
+
 @app.route('/profile')
 def profile():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
     user = db.session.get(User, session['user_id'])
-    checkins = CheckIn.query.filter_by(user_id=session['user_id']).order_by(CheckIn.check_in_time.desc()).limit(10).all()
+    history = checkin_history()
+    checkins = db.session.execute(db.select(history).where(
+        history.c.user_id == session['user_id']
+    ).order_by(history.c.check_in_time.desc()).limit(10)).all()
     
-    # 計算出席統計
-    total_events = Event.query.count()
-    attended_events = db.session.query(CheckIn.event_id).filter_by(user_id=session['user_id']).distinct().count()
-    missed_events = total_events - attended_events if total_events > 0 else 0
-    
-    # 計算出席率
-    attendance_rate = (attended_events / total_events * 100) if total_events > 0 else 0
+    # 計算出席統計（只計入加入後且已開始的活動）
+    stats = member_attendance(session['user_id'])
     
     return render_template('profile.html', 
                          user=user, 
                          checkins=checkins,
-                         total_events=total_events,
-                         attended_events=attended_events,
-                         missed_events=missed_events,
-                         attendance_rate=attendance_rate)
+                         member_calendar_url=calendar_url(f'member:{user.id}', user_id=user.id),
+                         chapter_calendar_url=calendar_url('chapter'),
+                         total_events=stats['eligible'],
+                         attended_events=stats['attended'],
+                         missed_events=stats['missed'],
+                         attendance_rate=stats['rate'])
 
 @app.route('/user/<int:user_id>')
 def view_user_profile(user_id):
@@ -348,19 +1049,18 @@ def view_user_profile(user_id):
         return redirect(url_for('events'))
     
     # 獲取用戶的簽到統計
-    checkin_count = CheckIn.query.filter_by(user_id=user_id).count()
+    history = checkin_history()
+    checkin_count = db.session.execute(
+        db.select(db.func.count()).select_from(history).where(history.c.user_id == user_id)
+    ).scalar()
     
     # 獲取用戶發起的活動
     organized_events = Event.query.filter_by(organizer_id=user_id).order_by(Event.created_at.desc()).limit(5).all()
     
-    # 計算缺席數和參與率
-    total_events = Event.query.count()
-    if total_events > 0:
-        attendance_rate = round((checkin_count / total_events) * 100, 1)
-        absent_count = total_events - checkin_count
-    else:
-        attendance_rate = 0
-        absent_count = 0
+    # 計算缺席數和參與率（只計入加入後且已開始的活動）
+    stats = member_attendance(user_id)
+    attendance_rate = stats['rate']
+    absent_count = stats['missed']
     
     return render_template('user_profile.html', 
                          user=user, 
@@ -424,11 +1124,42 @@ def events():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
+    materialize_due_series()
     events = Event.query.order_by(Event.created_at.desc()).all()
-    all_users = User.query.all()  # 新增：獲取所有用戶列表
+    all_users = member_directory()  # 新增：獲取所有用戶列表
     now = datetime.now()  # 新增：當前時間
     return render_template('events.html', events=events, all_users=all_users, now=now, has_permission=has_permission)
 
+@app.route('/api/search/events')
+def search_events():
+    """以標題、說明與地點搜尋活動，依相關度排序，同分時新的在前"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+    
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({'success': False, 'message': '請輸入搜尋關鍵字'})
+    
+    page, per_page = page_args()
+    query = search_filter(db.session.query(*dto_columns(EventHit, Event)), 'event_search', text)
+    rows, pagination = paginate_rows(query.order_by(Event.start_time.desc(), Event.id.desc()), page, per_page)
+    return jsonify({'success': True, 'events': [EventHit(*row) for row in rows], 'pagination': pagination})
+
+@app.route('/api/search/members')
+def search_members():
+    """以姓名（含編號與專業別）、職級與自介搜尋成員"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+    
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({'success': False, 'message': '請輸入搜尋關鍵字'})
+    
+    page, per_page = page_args()
+    query = search_filter(db.session.query(*dto_columns(MemberCard, User)), 'user_search', text)
+    rows, pagination = paginate_rows(query.order_by(User.id), page, per_page)
+    return jsonify({'success': True, 'members': [MemberCard(*row) for row in rows], 'pagination': pagination})
+
 @app.route('/event/<int:event_id>')
 def event_detail(event_id):
     if 'user_id' not in session:
@@ -442,44 +1173,35 @@ def event_detail(event_id):
     # 獲取當前用戶
     current_user = db.session.get(User, session['user_id'])
     
+    # 當前用戶的報名狀態（人數使用活動上的快取欄位，不需 COUNT 查詢）
+    registration = EventRegistration.query.filter_by(
+        event_id=event_id,
+        user_id=session['user_id']
+    ).first()
+    
     # 檢查當前用戶是否已簽到
     user_checkin = CheckIn.query.filter_by(
         user_id=session['user_id'], 
         event_id=event_id
     ).first()
     
-    # 獲取所有成員
-    all_users = User.query.all()
-    
-    # 獲取已簽到的成員
-    checked_in_users = db.session.query(CheckIn, User).join(
-        User, CheckIn.user_id == User.id
-    ).filter(CheckIn.event_id == event_id).all()
+    # 獲取所有成員（名錄快照）與本活動的簽到記錄
+    all_users = member_directory()
+    checkins = {checkin.user_id: checkin for checkin in CheckIn.query.filter_by(event_id=event_id)}
     
     # 創建出席狀況列表
-    attendance_list = []
-    checked_in_user_ids = [checkin.user_id for checkin, _ in checked_in_users]
-    
-    for user in all_users:
-        is_checked_in = user.id in checked_in_user_ids
-        checkin_record = None
-        if is_checked_in:
-            checkin_record = CheckIn.query.filter_by(
-                user_id=user.id, 
-                event_id=event_id
-            ).first()
-        
-        attendance_list.append({
-            'user': user,
-            'is_checked_in': is_checked_in,
-            'checkin_record': checkin_record
-        })
+    attendance_list = [{
+        'user': user,
+        'is_checked_in': user.id in checkins,
+        'checkin_record': checkins.get(user.id)
+    } for user in all_users]
     
     return render_template('event_detail.html', 
                          event=event, 
                          user_checkin=user_checkin,
                          all_users=all_users,
                          attendance_list=attendance_list,
+                         registration=registration,
                          now=datetime.now(),
                          has_permission=has_permission)  # 新增：當前時間
 
@@ -507,190 +1229,1576 @@ def event_checkin(event_id):
     
     selected_user_id = int(selected_user_id)
     
-    # 檢查是否已經在此活動簽到
-    existing_checkin = CheckIn.query.filter(
-        CheckIn.user_id == selected_user_id,
-        CheckIn.event_id == event_id
-    ).first()
-    
-    if existing_checkin:
+    # 以 INSERT ... ON CONFLICT DO NOTHING 寫入，同時送出的重複簽到由唯一索引略過，不會拋出 IntegrityError
+    inserted = insert_event_checkins([{
+        'user_id': selected_user_id,
+        'event_id': event_id,
+        'check_in_time': datetime.utcnow(),
+        'location': request.form.get('location', event.location),
+        'notes': request.form.get('notes', ''),
+        'status': 'checked_in'
+    }])
+    if not inserted:
+        db.session.rollback()
         return jsonify({'success': False, 'message': '該人員已經在此活動簽到過了！'})
     
-    # 創建活動簽到記錄
-    checkin = CheckIn(
-        user_id=selected_user_id,
-        event_id=event_id,
-        location=request.form.get('location', event.location),
-        notes=request.form.get('notes', '')
-    )
-    
-    db.session.add(checkin)
+    add_attended_counts({event_id: 1})
     db.session.commit()
-    
+
     return jsonify({'success': True, 'message': '活動簽到成功！'})
 
-@app.route('/admin')
-def admin():
-    if 'user_id' not in session or not session.get('is_admin'):
-        flash('權限不足！', 'error')
-        return redirect(url_for('index'))
-    
-    users = User.query.all()
-    checkins = CheckIn.query.order_by(CheckIn.check_in_time.desc()).limit(20).all()
-    events = Event.query.all()
-    
-    # 計算統計數據
-    attendance_rate = 0
-    if users:
-        total_checkins = CheckIn.query.count()
-        total_users = len(users)
-        attendance_rate = min(100, int((total_checkins / (total_users * 30)) * 100)) if total_users > 0 else 0
-    
-    return render_template('admin.html', users=users, checkins=checkins, events=events, attendance_rate=attendance_rate, has_permission=has_permission)
+def add_attended_counts(counts):
+    """依 {event_id: 增減數} 以單次 executemany 更新活動的簽到人數快取"""
+    counts = {event_id: delta for event_id, delta in counts.items() if delta}
+    if not counts:
+        return
+    event_table = Event.__table__
+    db.session.execute(
+        event_table.update()
+        .where(event_table.c.id == db.bindparam('b_event_id'))
+        .values(attended_count=event_table.c.attended_count + db.bindparam('b_delta')),
+        [{'b_event_id': event_id, 'b_delta': delta} for event_id, delta in counts.items()]
+    )
 
-@app.route('/admin/users')
-def admin_users():
-    if 'user_id' not in session or not session.get('is_admin'):
-        return jsonify({'success': False, 'message': '權限不足'})
-    
-    users = User.query.all()
-    user_list = []
-    
-    for user in users:
-        user_list.append({
-            'id': user.id,
-            'username': user.username,
-            'name': user.name,
-            'email': user.email,
-            'phone': user.phone,
-            'is_admin': user.is_admin,
-            'created_at': user.created_at.strftime('%Y-%m-%d %H:%M:%S')
-        })
-    
-    return jsonify({'success': True, 'users': user_list})
+# 離線簽到同步設定
+SYNC_BATCH_LIMIT = 500  # 單次同步最多筆數
+SYNC_CLOCK_SKEW = timedelta(minutes=5)  # 允許的門口裝置時鐘誤差
 
-@app.route('/admin/users/<int:user_id>')
-def get_user_detail(user_id):
-    if 'user_id' not in session or not session.get('is_admin'):
-        return jsonify({'success': False, 'message': '權限不足'})
-    
-    user = db.session.get(User, user_id)
-    if not user:
-        return jsonify({'success': False, 'message': '用戶不存在'})
-    
-    return jsonify({
-        'success': True,
-        'user': {
-            'id': user.id,
-            'username': user.username,
-            'name': user.name,
-            'email': user.email,
-            'phone': user.phone,
-            'line_id': user.line_id,
-            'position': user.position,
-            'is_admin': user.is_admin,
-            'can_add_events': user.can_add_events,
-            'can_edit_events': user.can_edit_events,
-            'can_delete_events': user.can_delete_events,
-            'can_manage_users': user.can_manage_users,
-            'created_at': user.created_at.strftime('%Y-%m-%d %H:%M:%S')
-        }
-    })
+def parse_client_time(value):
+    """解析客戶端 ISO 時間，回傳 (本地時間, UTC 時間)，皆為不含時區的 datetime"""
+    client_time = datetime.fromisoformat(value)
+    if client_time.tzinfo is None:
+        client_time = client_time.astimezone()
+    local_time = client_time.astimezone().replace(tzinfo=None)
+    utc_time = client_time.astimezone(timezone.utc).replace(tzinfo=None)
+    return local_time, utc_time
 
-@app.route('/admin/checkins')
-def admin_checkins():
-    if 'user_id' not in session or not session.get('is_admin'):
-        return jsonify({'success': False, 'message': '權限不足'})
-    
-    checkins = CheckIn.query.order_by(CheckIn.check_in_time.desc()).all()
-    checkin_list = []
-    
-    for checkin in checkins:
-        user = db.session.get(User, checkin.user_id)
-        checkin_list.append({
-            'id': checkin.id,
-            'user_name': user.name if user else 'Unknown',
-            'check_in_time': checkin.check_in_time.strftime('%Y-%m-%d %H:%M:%S'),
-            'check_out_time': checkin.check_out_time.strftime('%Y-%m-%d %H:%M:%S') if checkin.check_out_time else None,
-            'location': checkin.location,
-            'status': checkin.status
-        })
-    
-    return jsonify({'success': True, 'checkins': checkin_list})
+def apply_checkin_ops(operations):
+    """在目前交易中套用一批簽到操作，回傳每筆操作的結果（不提交）"""
+    results = []
+    pending = []
+    seen_keys = set()
 
-@app.route('/admin/events/add', methods=['POST'])
-def add_event():
+    for op in operations:
+        key = str(op.get('key') or '') if isinstance(op, dict) else ''
+        if not key or len(key) > 64:
+            results.append({'key': key, 'status': 'invalid', 'message': '缺少或無效的冪等鍵'})
+            continue
+        if key in seen_keys:
+            results.append({'key': key, 'status': 'duplicate', 'message': '重複的簽到操作'})
+            continue
+        seen_keys.add(key)
+
+        try:
+            event_id = int(op['event_id'])
+            user_id = int(op['user_id'])
+            local_time, utc_time = parse_client_time(op['client_time'])
+        except (KeyError, TypeError, ValueError):
+            results.append({'key': key, 'status': 'invalid', 'message': '簽到資料格式錯誤'})
+            continue
+
+        result = {'key': key, 'event_id': event_id, 'user_id': user_id}
+        results.append(result)
+        pending.append((result, op, local_time, utc_time))
+
+    if not pending:
+        return results
+
+    # 以少量 IN 查詢一次取得去重、活動、成員與既有簽到資料
+    keys = [result['key'] for result, _, _, _ in pending]
+    event_ids = {result['event_id'] for result, _, _, _ in pending}
+    user_ids = {result['user_id'] for result, _, _, _ in pending}
+
+    synced_keys = {key for (key,) in db.session.query(CheckInSyncOp.idempotency_key).filter(
+        CheckInSyncOp.idempotency_key.in_(keys)
+    )}
+    events_by_id = {event.id: event for event in Event.query.filter(Event.id.in_(event_ids))}
+    known_user_ids = {user_id for (user_id,) in db.session.query(User.id).filter(User.id.in_(user_ids))}
+    checked_in = {(user_id, event_id) for user_id, event_id in db.session.query(CheckIn.user_id, CheckIn.event_id).filter(
+        CheckIn.event_id.in_(event_ids),
+        CheckIn.user_id.in_(user_ids)
+    )}
+
+    now = datetime.now()
+    attended = {}
+    for result, op, local_time, utc_time in pending:
+        if result['key'] in synced_keys:
+            result.update(status='duplicate', message='此簽到已同步')
+            continue
+
+        event = events_by_id.get(result['event_id'])
+        pair = (result['user_id'], result['event_id'])
+        if not event:
+            status, message = 'rejected', '活動不存在！'
+        elif result['user_id'] not in known_user_ids:
+            status, message = 'rejected', '簽到人員不存在！'
+        elif local_time > now + SYNC_CLOCK_SKEW:
+            status, message = 'rejected', '簽到時間晚於伺服器時間，請檢查裝置時鐘'
+        elif local_time < event.start_time - SYNC_CLOCK_SKEW:
+            status, message = 'rejected', '活動尚未開始，無法簽到！'
+        elif local_time > event.end_time + SYNC_CLOCK_SKEW:
+            status, message = 'rejected', '活動已結束，無法簽到！'
+        elif pair in checked_in:
+            status, message = 'already_checked_in', '該人員已經在此活動簽到過了！'
+        else:
+            status, message = 'created', '活動簽到成功！'
+
+        sync_op = CheckInSyncOp(
+            idempotency_key=result['key'],
+            event_id=result['event_id'],
+            user_id=result['user_id'],
+            client_time=local_time,
+            result=status
+        )
+        if status == 'created':
+            sync_op.checkin = CheckIn(
+                user_id=result['user_id'],
+                event_id=result['event_id'],
+                check_in_time=utc_time,
+                location=op.get('location') or event.location,
+                notes=op.get('notes') or ''
+            )
+            checked_in.add(pair)
+            attended[result['event_id']] = attended.get(result['event_id'], 0) + 1
+        db.session.add(sync_op)
+        result.update(status=status, message=message)
+
+    add_attended_counts(attended)
+    return results
+
+@app.route('/api/checkin/sync', methods=['POST'])
+def sync_checkins():
+    """批次同步門口裝置離線記錄的簽到操作"""
     if 'user_id' not in session:
         return jsonify({'success': False, 'message': '請先登入'})
-    
-    # 檢查權限
-    if not has_permission('add_events'):
-        return jsonify({'success': False, 'message': '權限不足，無法新增活動'})
-    
-    try:
-        title = request.form['title']
-        description = request.form['description']
-        start_time = request.form['start_time']
-        end_time = request.form['end_time']
-        location = request.form['location']
-        organizer_id = request.form.get('organizer_id')
-        max_participants = request.form.get('max_participants')
-        
-        if not title or not start_time or not end_time or not location or not organizer_id:
-            return jsonify({'success': False, 'message': '請填寫所有必填欄位'})
-        
-        # 檢查發起人是否存在
-        organizer = db.session.get(User, organizer_id)
-        if not organizer:
-            return jsonify({'success': False, 'message': '發起人不存在'})
-        
-        event = Event(
-            title=title,
-            description=description,
-            location=location,
-            organizer_id=organizer_id,
-            start_time=datetime.fromisoformat(start_time),
-            end_time=datetime.fromisoformat(end_time),
-            max_participants=int(max_participants) if max_participants else 0
-        )
-        
+
+    payload = request.get_json(silent=True) or {}
+    operations = payload.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'success': False, 'message': '沒有需要同步的簽到資料'})
+
+    if len(operations) > SYNC_BATCH_LIMIT:
+        return jsonify({'success': False, 'message': f'單次最多同步 {SYNC_BATCH_LIMIT} 筆簽到'})
+
+    for attempt in range(2):
+        try:
+            results = apply_checkin_ops(operations)
+            db.session.commit()
+            break
+        except IntegrityError:
+            # 其他請求同時寫入了相同的冪等鍵，重試時會被判定為重複操作
+            db.session.rollback()
+            if attempt:
+                return jsonify({'success': False, 'message': '同步衝突，請稍後重試'})
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': f'同步失敗：{str(e)}'})
+
+    return jsonify({'success': True, 'results': results})
+
+@app.route('/checkin-sw.js')
+def checkin_service_worker():
+    """離線簽到 Service Worker，從根路徑提供以涵蓋所有活動頁面"""
+    response = app.send_static_file('js/checkin-sw.js')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# 行事曆訂閱設定
+CALENDAR_PAST_DAYS = 90  # 訂閱內容包含多久以前的活動
+calendar_cache = {}
+
+def calendar_token(feed):
+    """行事曆訂閱網址的簽章；行事曆用戶端不會帶登入 Cookie，以網址中的憑證驗證"""
+    secret = app.config.get('CALENDAR_SECRET') or app.config['SECRET_KEY']
+    digest = hmac.new(secret.encode(), b'calendar:' + chapter_scoped(feed).encode(), hashlib.sha256).digest()[:12]
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def calendar_url(feed, **values):
+    chapter = current_chapter()
+    if chapter != DEFAULT_CHAPTER:
+        values['chapter'] = chapter
+    return url_for(f'calendar_{feed.split(":")[0]}', token=calendar_token(feed), _external=True, **values)
+
+def use_url_chapter(chapter):
+    """行事曆用戶端沒有登入 session，分會由網址決定；回傳分會是否存在"""
+    if chapter is None:
+        return True
+    if chapter not in CHAPTERS:
+        return False
+    current_chapter_var.set(chapter)
+    return True
+
+def ics_text(value):
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+def ics_time(moment):
+    """活動時間以本地時間儲存，輸出時轉成 UTC"""
+    return moment.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+def ics_fold(line):
+    """RFC 5545：每行最多 75 位元組，續行以空白開頭，不可切斷 UTF-8 字元"""
+    data = line.encode()
+    if len(data) <= 75:
+        return data
+    parts, start, limit = [], 0, 75
+    while start < len(data):
+        end = min(start + limit, len(data))
+        while end < len(data) and (data[end] & 0xC0) == 0x80:
+            end -= 1
+        parts.append(data[start:end])
+        start, limit = end, 74
+    return b'\r\n '.join(parts)
+
+def build_calendar(name, rows, host):
+    """rows 為 (id, title, description, start, end, location, created_at, organizer_name, organizer_email)"""
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//bniserver//checkin//ZH', 'CALSCALE:GREGORIAN',
+             'METHOD:PUBLISH', f'X-WR-CALNAME:{ics_text(name)}', 'X-PUBLISHED-TTL:PT15M']
+    for event_id, title, description, start, end, location, created_at, organizer_name, organizer_email in rows:
+        lines += ['BEGIN:VEVENT', f'UID:event-{event_id}@{host}',
+                  f'DTSTAMP:{(created_at or datetime.utcnow()).strftime("%Y%m%dT%H%M%SZ")}',
+                  f'DTSTART:{ics_time(start)}', f'DTEND:{ics_time(end)}',
+                  f'SUMMARY:{ics_text(title)}', f'LOCATION:{ics_text(location)}']
+        if description:
+            lines.append(f'DESCRIPTION:{ics_text(description)}')
+        if organizer_name:
+            organizer = f'mailto:{organizer_email}' if organizer_email else f'urn:bniserver:organizer:{event_id}'
+            lines.append(f'ORGANIZER;CN="{organizer_name.replace(chr(34), "")}":{organizer}')
+        lines.append('END:VEVENT')
+    lines.append('END:VCALENDAR')
+    return b'\r\n'.join(ics_fold(line) for line in lines) + b'\r\n'
+
+def calendar_rows(now, user_id=None):
+    """一次查詢活動與發起人；指定成員時只包含其報名或發起的活動"""
+    query = db.session.query(
+        Event.id, Event.title, Event.description, Event.start_time, Event.end_time, Event.location,
+        Event.created_at, User.name, User.email
+    ).outerjoin(User, User.id == Event.organizer_id).filter(
+        Event.end_time >= now - timedelta(days=CALENDAR_PAST_DAYS)
+    )
+    if user_id is not None:
+        registered = db.select(EventRegistration.event_id).where(
+            EventRegistration.user_id == user_id, EventRegistration.status != 'cancelled'
+        )
+        query = query.filter(db.or_(Event.id.in_(registered), Event.organizer_id == user_id))
+    return query.order_by(Event.start_time).all()
+
+def calendar_response(key, name, user_id=None):
+    """以預先序列化的內容回應；活動、報名與成員世代未變時不查詢資料表，條件請求直接回 304"""
+    now = datetime.now()
+    generation = cache_generation('events', 'users')
+    key = (current_chapter(), key)
+    entry = cache_lookup(calendar_cache, key, generation, now)
+    if entry is None:
+        body = build_calendar(name, calendar_rows(now, user_id), request.host)
+        midnight = datetime.combine(now.date() + timedelta(days=1), time.min)
+        entry = cache_store(calendar_cache, key, generation, midnight, (
+            body, hashlib.sha1(body).hexdigest(), datetime.now(timezone.utc).replace(microsecond=0)
+        ))
+    body, etag, last_modified = entry
+    response = Response(body, mimetype='text/calendar')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, max-age=900'
+    return response.make_conditional(request)
+
+@app.route('/calendar/chapter.ics', defaults={'chapter': None})
+@app.route('/calendar/<chapter>/chapter.ics')
+def calendar_chapter(chapter):
+    """分會行事曆：所有活動"""
+    if not use_url_chapter(chapter) or not hmac.compare_digest(request.args.get('token', ''), calendar_token('chapter')):
+        return Response('無效的訂閱網址', status=403)
+    return calendar_response('chapter', f'{CHAPTERS[current_chapter()]}活動')
+
+@app.route('/calendar/member/<int:user_id>.ics', defaults={'chapter': None})
+@app.route('/calendar/<chapter>/member/<int:user_id>.ics')
+def calendar_member(user_id, chapter):
+    """個人行事曆：已報名或發起的活動"""
+    if not use_url_chapter(chapter) or not hmac.compare_digest(request.args.get('token', ''), calendar_token(f'member:{user_id}')):
+        return Response('無效的訂閱網址', status=403)
+    return calendar_response(('member', user_id), '我的活動', user_id)
+
+# QR 簽到憑證設定
+QR_TOKEN_EARLY = timedelta(minutes=30)  # 活動開始前多久可以掃碼簽到
+QR_UPLOAD_GRACE = timedelta(hours=2)  # 離線掃描在活動結束後多久內仍可上傳
+
+def qr_signature(payload):
+    """以 HMAC-SHA256 簽署 QR 憑證內容（截斷為 96 位元以縮短 QR 碼）"""
+    secret = app.config.get('CHECKIN_QR_SECRET') or app.config['SECRET_KEY']
+    digest = hmac.new(secret.encode(), b'checkin-qr:' + payload.encode(), hashlib.sha256).digest()[:12]
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def make_checkin_token(event, user_id):
+    """產生綁定分會、活動、成員與簽到時間窗的 QR 憑證
+
+    非預設分會的憑證以「分會代號:」開頭，掃描端不需登入該分會也能找到對應的資料庫。
+    """
+    not_before = int((event.start_time - QR_TOKEN_EARLY).timestamp())
+    expires = int(event.end_time.timestamp())
+    payload = chapter_scoped(f'{event.id}.{user_id}.{not_before}.{expires}')
+    return f'{payload}.{qr_signature(payload)}'
+
+def checkin_token_chapter(token):
+    """QR 憑證所屬的分會；沒有分會前綴的是預設分會的憑證（與登入的分會無關），未知的分會回傳 None"""
+    chapter, separator, _ = token.partition(':') if isinstance(token, str) else ('', '', '')
+    if not separator:
+        return DEFAULT_CHAPTER
+    return chapter if chapter in CHAPTERS else None
+
+def verify_checkin_token(token, at=None, now=None):
+    """驗證 QR 憑證的簽章與時間窗，不讀取資料庫；回傳 (分會, event_id, user_id, 狀態, 訊息)
+
+    at 為裝置記錄的掃描時間；不論掃描時間為何，伺服器收到時已超過活動結束加上補登期限就拒絕。
+    """
+    chapter = checkin_token_chapter(token)
+    try:
+        payload, signature = token.rsplit('.', 1)
+        event_id, user_id, not_before, expires = (int(part) for part in payload.rpartition(':')[2].split('.'))
+    except (AttributeError, ValueError):
+        return None, None, None, 'invalid', '無效的簽到憑證'
+
+    if chapter is None:
+        return None, None, None, 'invalid', '無效的簽到憑證'
+    if not hmac.compare_digest(signature, qr_signature(payload)):
+        return None, None, None, 'invalid', '無效的簽到憑證'
+
+    now = now or datetime.now()
+    if now.timestamp() > expires + QR_UPLOAD_GRACE.total_seconds():
+        return chapter, event_id, user_id, 'rejected', '活動已結束，無法簽到！'
+    timestamp = (at or now).timestamp()
+    if timestamp < not_before:
+        return chapter, event_id, user_id, 'rejected', '活動尚未開始，無法簽到！'
+    if timestamp > expires:
+        return chapter, event_id, user_id, 'rejected', '活動已結束，無法簽到！'
+    return chapter, event_id, user_id, 'valid', None
+
+def insert_event_checkins(rows):
+    """以單一 INSERT 寫入活動簽到，已簽到者由唯一索引略過；回傳實際新增的 (user_id, event_id)"""
+    if not rows:
+        return set()
+    stmt = sqlite_insert(CheckIn).values(rows).on_conflict_do_nothing().returning(
+        CheckIn.user_id, CheckIn.event_id
+    )
+    return {(user_id, event_id) for user_id, event_id in db.session.execute(stmt)}
+
+@app.route('/admin/events/<int:event_id>/qr_tokens')
+def event_qr_tokens(event_id):
+    """批次產生活動所有成員的 QR 簽到憑證"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+
+    if not has_permission('edit_events'):
+        return jsonify({'success': False, 'message': '權限不足'})
+
+    event = db.session.get(Event, event_id)
+    if not event:
+        return jsonify({'success': False, 'message': '活動不存在'})
+
+    # 如果不是管理員，只能產生自己發起的活動憑證
+    if not session.get('is_admin') and event.organizer_id != session['user_id']:
+        return jsonify({'success': False, 'message': '只能產生自己發起的活動憑證'})
+
+    members = db.session.query(User.id, User.name).order_by(User.id).all()
+    tokens = [
+        {'user_id': user_id, 'name': name, 'token': make_checkin_token(event, user_id)}
+        for user_id, name in members
+    ]
+
+    if request.args.get('format') == 'json':
+        return jsonify({'success': True, 'event_id': event.id, 'tokens': tokens})
+
+    return render_template('event_qr_tokens.html', event=event, tokens=tokens)
+
+@app.route('/api/checkin/scan', methods=['POST'])
+def scan_checkin():
+    """掃描 QR 憑證簽到，支援單筆 token 或離線掃描的批次上傳"""
+    payload = request.get_json(silent=True) or {}
+    if 'tokens' in payload:
+        scans = payload['tokens']
+        if not isinstance(scans, list) or not scans:
+            return jsonify({'success': False, 'message': '沒有需要上傳的掃描資料'})
+        if len(scans) > SYNC_BATCH_LIMIT:
+            return jsonify({'success': False, 'message': f'單次最多上傳 {SYNC_BATCH_LIMIT} 筆掃描'})
+    elif payload.get('token'):
+        scans = [payload]
+    else:
+        return jsonify({'success': False, 'message': '缺少簽到憑證'})
+
+    now = datetime.now()
+    # 掃描端點不需登入；只有登入且可編輯活動的門口裝置，才採用它記錄的掃描時間與地點
+    # 權限只在登入的分會有效，其他分會的憑證一律以伺服器時間簽到
+    home = current_chapter()
+    trusted = has_permission('edit_events')
+    results = []
+    rows = {}
+    for scan in scans:
+        # 批次項目可以是憑證字串，或帶有 scanned_at 的物件
+        token, scanned_at, utc_time = scan, None, None
+        if isinstance(scan, dict):
+            token = scan.get('token')
+            if scan.get('scanned_at') and trusted and checkin_token_chapter(token) == home:
+                try:
+                    scanned_at, utc_time = parse_client_time(scan['scanned_at'])
+                except (TypeError, ValueError):
+                    results.append({'token': token, 'status': 'invalid', 'message': '掃描時間格式錯誤'})
+                    continue
+                if scanned_at > now + SYNC_CLOCK_SKEW:
+                    results.append({'token': token, 'status': 'rejected', 'message': '掃描時間晚於伺服器時間，請檢查裝置時鐘'})
+                    continue
+
+        chapter, event_id, user_id, status, message = verify_checkin_token(token, scanned_at, now)
+        result = {'token': token, 'chapter': chapter, 'event_id': event_id, 'user_id': user_id,
+                  'status': status, 'message': message}
+        results.append(result)
+        if status == 'valid' and (user_id, event_id) not in rows.setdefault(chapter, {}):
+            rows[chapter][(user_id, event_id)] = {
+                'user_id': user_id,
+                'event_id': event_id,
+                'check_in_time': utc_time or datetime.utcnow(),
+                'location': payload.get('location') if trusted and chapter == home else None,
+                'notes': 'QR簽到',
+                'status': 'checked_in'
+            }
+
+    # 依憑證所屬的分會分別寫入各自的資料庫
+    inserted = set()
+    try:
+        for chapter, chapter_rows in rows.items():
+            with chapter_context(chapter):
+                pairs = insert_event_checkins(list(chapter_rows.values()))
+                attended = {}
+                for _, event_id in pairs:
+                    attended[event_id] = attended.get(event_id, 0) + 1
+                add_attended_counts(attended)
+                db.session.commit()
+            inserted |= {(chapter, user_id, event_id) for user_id, event_id in pairs}
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'簽到失敗：{str(e)}'})
+
+    for result in results:
+        if result['status'] != 'valid':
+            continue
+        key = (result['chapter'], result['user_id'], result['event_id'])
+        if key in inserted:
+            inserted.discard(key)
+            result.update(status='created', message='活動簽到成功！')
+        else:
+            result.update(status='already_checked_in', message='該人員已經在此活動簽到過了！')
+
+    if 'tokens' in payload:
+        return jsonify({'success': True, 'results': results})
+
+    result = results[0]
+    return jsonify({'success': result['status'] == 'created', 'message': result['message'],
+                    'event_id': result['event_id'], 'user_id': result['user_id'], 'status': result['status']})
+
+def register_for_event(event_id, user_id):
+    """報名活動；以條件式 UPDATE 原子地佔用名額，額滿時列入候補（不提交）"""
+    registration = EventRegistration.query.filter_by(event_id=event_id, user_id=user_id).first()
+    if registration and registration.status != 'cancelled':
+        return registration, False
+
+    # 只有仍有名額（或不限人數）時才會更新成功，SQLite 的寫入鎖保證不會超賣
+    claimed = db.session.execute(
+        db.update(Event)
+        .where(
+            Event.id == event_id,
+            db.or_(
+                Event.max_participants.is_(None),
+                Event.max_participants <= 0,
+                Event.registered_count < Event.max_participants
+            )
+        )
+        .values(registered_count=Event.registered_count + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    status = 'registered' if claimed else 'waitlisted'
+
+    if registration:
+        registration.status = status
+        registration.registered_at = datetime.utcnow()
+    else:
+        registration = EventRegistration(event_id=event_id, user_id=user_id, status=status)
+        db.session.add(registration)
+    db.session.flush()
+    return registration, True
+
+def cancel_registration(registration):
+    """取消報名；釋出的名額在同一交易中由最早的候補成員遞補（不提交）"""
+    was_registered = registration.status == 'registered'
+    registration.status = 'cancelled'
+    db.session.flush()
+    if not was_registered:
+        return None
+
+    event = db.session.get(Event, registration.event_id, populate_existing=True)
+    has_seat = not event.max_participants or event.registered_count - 1 < event.max_participants
+    promoted = None
+    if has_seat:
+        promoted = EventRegistration.query.filter_by(
+            event_id=registration.event_id,
+            status='waitlisted'
+        ).order_by(EventRegistration.registered_at, EventRegistration.id).first()
+
+    if promoted:
+        # 名額直接轉給候補成員，報名人數不變
+        promoted.status = 'registered'
+    else:
+        db.session.execute(
+            db.update(Event)
+            .where(Event.id == registration.event_id)
+            .values(registered_count=Event.registered_count - 1)
+            .execution_options(synchronize_session=False)
+        )
+    db.session.flush()
+    return promoted
+
+def fill_from_waitlist(event):
+    """人數上限提高後，以一次 UPDATE 讓候補成員依序遞補空出的名額（不提交）"""
+    waitlisted = db.select(EventRegistration.id).where(
+        EventRegistration.event_id == event.id,
+        EventRegistration.status == 'waitlisted'
+    ).order_by(EventRegistration.registered_at, EventRegistration.id)
+    db.session.refresh(event, ['registered_count'])
+    if event.max_participants:
+        free_seats = event.max_participants - event.registered_count
+        if free_seats <= 0:
+            return 0
+        waitlisted = waitlisted.limit(free_seats)
+
+    promoted = db.session.execute(
+        db.update(EventRegistration)
+        .where(EventRegistration.id.in_(waitlisted.scalar_subquery()))
+        .values(status='registered')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if promoted:
+        event.registered_count = Event.registered_count + promoted
+    return promoted
+
+def registration_target_user_id():
+    """管理員可以替其他成員報名或取消，其他人只能操作自己"""
+    user_id = request.form.get('user_id')
+    if user_id and session.get('is_admin'):
+        return int(user_id)
+    return session['user_id']
+
+@app.route('/event/<int:event_id>/register', methods=['POST'])
+def event_register(event_id):
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+    
+    event = db.session.get(Event, event_id)
+    if not event:
+        return jsonify({'success': False, 'message': '活動不存在！'})
+    
+    if event.end_time < datetime.now():
+        return jsonify({'success': False, 'message': '活動已結束，無法報名！'})
+    
+    try:
+        registration, created = register_for_event(event_id, registration_target_user_id())
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': '已經報名過此活動'})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'報名失敗：{str(e)}'})
+    
+    if not created:
+        message = '已經報名過此活動' if registration.status == 'registered' else '已在候補名單中'
+        return jsonify({'success': False, 'message': message, 'status': registration.status})
+    
+    message = '報名成功！' if registration.status == 'registered' else '活動已額滿，已列入候補名單'
+    return jsonify({'success': True, 'message': message, 'status': registration.status})
+
+@app.route('/event/<int:event_id>/cancel', methods=['POST'])
+def event_cancel_registration(event_id):
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+    
+    registration = EventRegistration.query.filter(
+        EventRegistration.event_id == event_id,
+        EventRegistration.user_id == registration_target_user_id(),
+        EventRegistration.status.in_(['registered', 'waitlisted'])
+    ).first()
+    if not registration:
+        return jsonify({'success': False, 'message': '尚未報名此活動'})
+    
+    try:
+        promoted = cancel_registration(registration)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'取消報名失敗：{str(e)}'})
+    
+    return jsonify({
+        'success': True,
+        'message': '已取消報名',
+        'promoted_user_id': promoted.user_id if promoted else None
+    })
+
+@app.route('/admin')
+def admin():
+    if 'user_id' not in session or not session.get('is_admin'):
+        flash('權限不足！', 'error')
+        return redirect(url_for('index'))
+    
+    # 各面板（成員、活動、簽到、統計）由頁面以 AJAX 分頁載入
+    return render_template('admin.html', has_permission=has_permission, permission_fields=PERMISSION_FIELDS, role_presets=ROLE_PRESETS)
+
+# 管理 API 的回應資料結構：由欄位投影查詢直接建立，不載入完整 ORM 物件
+@dataclass(slots=True, frozen=True)
+class MemberRow:
+    id: int
+    username: str
+    name: str
+    email: str | None
+    phone: str | None
+    line_id: str | None
+    position: str | None
+    is_admin: bool
+    created_at: datetime | None
+
+@dataclass(slots=True, frozen=True)
+class MemberDetail:
+    id: int
+    username: str
+    name: str
+    email: str | None
+    phone: str | None
+    line_id: str | None
+    position: str | None
+    is_admin: bool
+    permissions: int
+    created_at: datetime | None
+
+@dataclass(slots=True, frozen=True)
+class MemberCard:
+    id: int
+    name: str
+    position: str | None
+    avatar: str | None
+    email: str | None
+    phone: str | None
+    line_id: str | None
+
+@dataclass(slots=True, frozen=True)
+class EventHit:
+    id: int
+    title: str
+    location: str
+    start_time: datetime
+    end_time: datetime
+    registered_count: int
+    max_participants: int | None
+
+@dataclass(slots=True, frozen=True)
+class CheckInRow:
+    id: int
+    user_name: str
+    check_in_time: datetime | None
+    check_out_time: datetime | None
+    location: str | None
+    status: str | None
+
+@dataclass(slots=True, frozen=True)
+class AuditEntry:
+    id: int
+    actor_id: int | None
+    actor_name: str | None
+    action: str
+    target_type: str | None
+    target_id: int | None
+    changes: dict | None
+    ip: str | None
+    created_at: datetime
+
+def dto_columns(dto, model):
+    """依資料結構的欄位順序取出模型欄位，查詢結果可直接以位置參數建立"""
+    return [getattr(model, field.name) for field in fields(dto)]
+
+# 管理後台面板設定
+kpi_cache = {}
+
+def page_args(default_per_page=20, max_per_page=100):
+    """讀取分頁參數，回傳 (page, per_page)"""
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', default_per_page, type=int), 1), max_per_page)
+    return page, per_page
+
+def paginate_rows(query, page, per_page):
+    """多取一筆判斷是否還有下一頁，不需要另外 COUNT"""
+    rows = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+    return rows[:per_page], {'page': page, 'per_page': per_page, 'has_more': len(rows) > per_page}
+
+def compute_kpis(now):
+    """以單一彙總查詢取得管理後台的所有統計數據"""
+    offset_seconds = int(datetime.now().astimezone().utcoffset().total_seconds())
+    joined = db.func.datetime(User.created_at, f'{offset_seconds:+d} seconds')
+    today_start = datetime.combine(now.date(), time.min).astimezone(timezone.utc).replace(tzinfo=None)
+
+    history = checkin_history()
+
+    def scalar(statement):
+        return statement.scalar_subquery()
+
+    row = db.session.query(
+        scalar(db.select(db.func.count(User.id))),
+        scalar(db.select(db.func.count(Event.id))),
+        scalar(db.select(db.func.count(Event.id)).where(Event.start_time > now)),
+        scalar(db.select(db.func.count()).select_from(history)),
+        scalar(db.select(db.func.count(CheckIn.id)).where(CheckIn.check_in_time >= today_start)),
+        # 應出席場次：每位成員加入後且已開始的活動數總和
+        scalar(db.select(db.func.coalesce(db.func.sum(
+            db.select(db.func.count(Event.id)).where(
+                Event.start_time <= now,
+                db.or_(User.created_at.is_(None), Event.start_time >= joined)
+            ).correlate(User).scalar_subquery()
+        ), 0))),
+        # 實際出席場次
+        scalar(db.select(db.func.count()).select_from(history).join(Event, Event.id == history.c.event_id).join(
+            User, User.id == history.c.user_id
+        ).where(
+            Event.start_time <= now,
+            db.or_(User.created_at.is_(None), Event.start_time >= joined)
+        ))
+    ).one()
+
+    total_users, total_events, upcoming_events, total_checkins, today_checkins, eligible, attended = row
+    return {
+        'total_users': total_users,
+        'total_events': total_events,
+        'upcoming_events': upcoming_events,
+        'total_checkins': total_checkins,
+        'today_checkins': today_checkins,
+        'attendance_rate': attendance_stats(eligible, attended)['rate'],
+        'eligible_events': eligible,
+        'attended_events': attended
+    }
+
+def cached_kpis(refresh=False):
+    """統計數據在世代變動、下一場活動開始或跨日（今日簽到數歸零）前都有效"""
+    now = datetime.now()
+    generation = cache_generation('users', 'events', 'checkins')
+    kpis = None if refresh else cache_lookup(kpi_cache, current_chapter(), generation, now)
+    if kpis is None:
+        midnight = datetime.combine(now.date() + timedelta(days=1), time.min)
+        valid_until = min(filter(None, (next_event_start(now), midnight)))
+        kpis = cache_store(kpi_cache, current_chapter(), generation, valid_until, compute_kpis(now))
+    return kpis
+
+@app.route('/admin/kpis')
+def admin_kpis():
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    # 統計數據依資料世代快取，管理員頻繁重整頁面時不會重複彙總
+    kpis = cached_kpis(refresh=bool(request.args.get('refresh')))
+    
+    return jsonify({'success': True, 'kpis': kpis})
+
+def is_region_admin():
+    """預設分會作為區域總部，其管理員可以查看所有分會的彙總"""
+    return bool(session.get('is_admin')) and session.get('chapter', DEFAULT_CHAPTER) == DEFAULT_CHAPTER
+
+@app.route('/admin/region/kpis')
+def admin_region_kpis():
+    """區域彙總：平行查詢每個分會的統計數據，各分會使用自己的資料庫連線與快取"""
+    if 'user_id' not in session or not is_region_admin():
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    results = fan_out(cached_kpis)
+    chapters = [{'chapter': slug, 'name': CHAPTERS[slug], **kpis} for slug, kpis in results.items()]
+    totals = {
+        key: sum(item[key] for item in chapters)
+        for key in ('total_users', 'total_events', 'upcoming_events', 'total_checkins', 'today_checkins', 'eligible_events', 'attended_events')
+    }
+    totals['attendance_rate'] = attendance_stats(totals['eligible_events'], totals['attended_events'])['rate']
+    return jsonify({'success': True, 'chapters': chapters, 'totals': totals})
+
+# 到場曲線
+# 簽到依相對活動開始時間的分鐘分組（例如 -3 表示開始前 3 分鐘內、0 表示開始後第一分鐘），
+# 分組在 SQLite 以 GROUP BY 一次算完多個活動，Python 只處理每場幾十個分組。
+# 已結束的活動保存在 arrival_curve；進行中的活動在記憶體中只累加上次之後的新簽到。
+ARRIVAL_GRACE_MINUTES = int(os.environ.get('ARRIVAL_GRACE_MINUTES', 1))  # 開始後幾分鐘內簽到仍算準時
+
+class LiveArrivals:
+    """進行中活動的到場分布快照，更新時建立新物件取代，不會被其他執行緒改到一半"""
+    __slots__ = ('start_time', 'last_id', 'total', 'buckets')
+
+    def __init__(self, start_time, last_id, total, buckets):
+        self.start_time = start_time
+        self.last_id = last_id
+        self.total = total
+        self.buckets = buckets
+
+live_arrivals = {}  # {(分會代號, event_id): LiveArrivals}
+
+@dataclass(slots=True, frozen=True)
+class ArrivalSummary:
+    event_id: int
+    title: str
+    start_time: datetime
+    total: int
+    on_time: int
+    late: int
+    on_time_rate: float
+    peak_minute: int | None  # 簽到最多的分鐘（相對開始時間）
+    peak_count: int
+
+def count_arrivals(events, after_id=0, archived=True):
+    """以單一分組查詢計算多個活動的到場分布，回傳 {event_id: (分組, 人數, 最大簽到 ID)}
+
+    活動開始時間以整分鐘為單位，簽到時間（UTC）換算成分鐘後減去開始的分鐘即為相對分鐘。
+    """
+    source = checkin_history() if archived else CheckIn.__table__
+    minute = db.cast(db.func.strftime('%s', source.c.check_in_time), db.Integer) // 60
+    rows = db.session.query(
+        source.c.event_id, minute, db.func.count(), db.func.max(source.c.id)
+    ).filter(
+        source.c.event_id.in_([event.id for event in events]),
+        source.c.id > after_id
+    ).group_by(source.c.event_id, minute).all()
+
+    starts = {event.id: int(event.start_time.timestamp()) // 60 for event in events}
+    curves = {event.id: ({}, 0, after_id) for event in events}
+    for event_id, absolute_minute, count, last_id in rows:
+        buckets, total, max_id = curves[event_id]
+        if absolute_minute is not None:
+            buckets[absolute_minute - starts[event_id]] = count
+        curves[event_id] = (buckets, total + count, max(max_id, last_id))
+    return curves
+
+def live_arrival_curve(event):
+    """進行中活動只查詢上次之後的新簽到；人數與活動的簽到人數快取不符（有簽到被刪除）時重新計算"""
+    key = (current_chapter(), event.id)
+    snapshot = live_arrivals.get(key)
+    if snapshot is not None and snapshot.start_time == event.start_time:
+        new_buckets, new_total, last_id = count_arrivals([event], snapshot.last_id, archived=False)[event.id]
+        buckets = dict(snapshot.buckets)
+        for minute, count in new_buckets.items():
+            buckets[minute] = buckets.get(minute, 0) + count
+        snapshot = LiveArrivals(event.start_time, last_id, snapshot.total + new_total, buckets)
+    if snapshot is None or snapshot.start_time != event.start_time or snapshot.total != event.attended_count:
+        buckets, total, last_id = count_arrivals([event], archived=False)[event.id]
+        snapshot = LiveArrivals(event.start_time, last_id, total, buckets)
+    live_arrivals[key] = snapshot
+    return snapshot.buckets, snapshot.total
+
+def arrival_curves(events, now):
+    """取得多個活動的到場分布 {event_id: (分組, 人數)}
+
+    已結束的活動讀取保存的結果，缺少或過期的一次計算後以單一 INSERT 保存。
+    """
+    closed = [event for event in events if event.end_time <= now]
+    stored = {
+        row.event_id: row for row in ArrivalCurve.query.filter(ArrivalCurve.event_id.in_([event.id for event in closed]))
+    } if closed else {}
+
+    curves = {}
+    stale = []
+    for event in closed:
+        row = stored.get(event.id)
+        if row and row.start_time == event.start_time and row.total == event.attended_count:
+            curves[event.id] = ({minute: count for minute, count in json.loads(row.buckets)}, row.total)
+        else:
+            stale.append(event)
+        live_arrivals.pop((current_chapter(), event.id), None)
+
+    if stale:
+        computed = count_arrivals(stale)
+        statement = sqlite_insert(ArrivalCurve).values([{
+            'event_id': event.id,
+            'start_time': event.start_time,
+            'total': computed[event.id][1],
+            'buckets': json.dumps(sorted(computed[event.id][0].items())),
+            'computed_at': datetime.utcnow()
+        } for event in stale])
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['event_id'],
+            set_={name: statement.excluded[name] for name in ('start_time', 'total', 'buckets', 'computed_at')}
+        ))
+        db.session.commit()
+        curves.update({event_id: (buckets, total) for event_id, (buckets, total, _) in computed.items()})
+
+    for event in events:
+        if event.end_time > now:
+            curves[event.id] = live_arrival_curve(event)
+    return curves
+
+def arrival_summary(event, buckets, total):
+    on_time = sum(count for minute, count in buckets.items() if minute < ARRIVAL_GRACE_MINUTES)
+    late = sum(count for minute, count in buckets.items() if minute >= ARRIVAL_GRACE_MINUTES)
+    peak_minute, peak_count = max(buckets.items(), key=lambda item: (item[1], -item[0]), default=(None, 0))
+    return ArrivalSummary(
+        event.id, event.title, event.start_time, total, on_time, late,
+        round(on_time / total * 100, 1) if total else 0, peak_minute, peak_count
+    )
+
+@app.route('/api/events/<int:event_id>/arrivals')
+def event_arrivals(event_id):
+    """單一活動的到場曲線：統計摘要與每分鐘簽到人數"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+    
+    event = db.session.get(Event, event_id)
+    if not event:
+        return jsonify({'success': False, 'message': '活動不存在'})
+    
+    if event.organizer_id != session['user_id'] and not has_permission('edit_events'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    buckets, total = arrival_curves([event], datetime.now())[event.id]
+    return jsonify({
+        'success': True,
+        'summary': arrival_summary(event, buckets, total),
+        'grace_minutes': ARRIVAL_GRACE_MINUTES,
+        'buckets': sorted(buckets.items())
+    })
+
+@app.route('/admin/arrivals')
+def admin_arrivals():
+    """已開始活動的到場摘要，新的在前"""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    now = datetime.now()
+    page, per_page = page_args(default_per_page=50, max_per_page=500)
+    query = Event.query.filter(Event.start_time <= now).order_by(Event.start_time.desc(), Event.id.desc())
+    events, pagination = paginate_rows(query, page, per_page)
+    curves = arrival_curves(events, now) if events else {}
+    
+    return jsonify({
+        'success': True,
+        'grace_minutes': ARRIVAL_GRACE_MINUTES,
+        'arrivals': [arrival_summary(event, *curves[event.id]) for event in events],
+        'pagination': pagination
+    })
+
+@app.route('/admin/events')
+def admin_events():
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    page, per_page = page_args()
+    query = db.session.query(
+        Event.id, Event.title, Event.location, Event.start_time, Event.end_time,
+        Event.max_participants, Event.registered_count, Event.attended_count, User.name
+    ).outerjoin(User, User.id == Event.organizer_id).order_by(Event.start_time.desc(), Event.id.desc())
+    rows, pagination = paginate_rows(query, page, per_page)
+    
+    event_list = [{
+        'id': event_id,
+        'title': title,
+        'location': location,
+        'start_time': start_time.strftime('%Y-%m-%d %H:%M'),
+        'end_time': end_time.strftime('%Y-%m-%d %H:%M'),
+        'max_participants': max_participants,
+        'registered_count': registered_count,
+        'attended_count': attended_count,
+        'organizer_name': organizer_name
+    } for event_id, title, location, start_time, end_time, max_participants,
+          registered_count, attended_count, organizer_name in rows]
+    
+    return jsonify({'success': True, 'events': event_list, 'pagination': pagination})
+
+@app.route('/admin/attendance')
+def admin_attendance():
+    """成員出席率排行榜，可依月份或季度彙總"""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    period = request.args.get('period') or None
+    if period and period not in ATTENDANCE_PERIODS:
+        return jsonify({'success': False, 'message': '期間只能是 month 或 quarter'})
+    
+    limit = request.args.get('limit', type=int)
+    members = cached_attendance(period)
+    leaderboard = sorted(members, key=lambda member: (-member['rate'], -member['attended'], member['user_id']))
+    
+    return jsonify({
+        'success': True,
+        'period': period,
+        'leaderboard': leaderboard[:limit] if limit else leaderboard
+    })
+
+# 出席矩陣匯出
+XLSX_STATIC_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="出席" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+class StreamBuffer:
+    """只能寫入的緩衝區，讓 zipfile 邊壓縮邊把資料交給回應串流"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def member_profession(name):
+    """取出「編號/姓名/專業別」格式中的專業別"""
+    parts = (name or '').split('/')
+    return parts[2].strip() if len(parts) >= 3 else ''
+
+def attendance_matrix(start_date, end_date, now=None):
+    """成員 × 活動出席矩陣：先回傳表頭，之後逐列產生
+
+    出席資料以單一 (user_id, 欄位) 查詢取得並寫入每位成員的 bytearray，
+    加入前的場次以二分搜尋一次切出，不需要逐格查詢。
+    """
+    now = now or datetime.now()
+    range_end = min(datetime.combine(end_date + timedelta(days=1), time.min), now)
+    events = db.session.query(Event.id, Event.title, Event.start_time).filter(
+        Event.start_time >= datetime.combine(start_date, time.min),
+        Event.start_time < range_end
+    ).order_by(Event.start_time, Event.id).all()
+
+    columns = {event_id: index for index, (event_id, _, _) in enumerate(events)}
+    starts = [start_time for _, _, start_time in events]
+    header = ['成員', '專業別'] + [f'{start_time:%Y-%m-%d} {title}' for _, title, start_time in events]
+    header += ['出席', '應出席', '出席率(%)']
+
+    attended = {}
+    if events:
+        history = checkin_history()
+        pairs = db.session.query(history.c.user_id, history.c.event_id).filter(
+            history.c.event_id.in_(columns)
+        ).distinct()
+        for user_id, event_id in pairs:
+            row = attended.get(user_id)
+            if row is None:
+                row = attended[user_id] = bytearray(len(events))
+            row[columns[event_id]] = 1
+
+    def rows():
+        empty = bytes(len(events))
+        members = db.session.query(User.id, User.name, User.created_at).order_by(User.id)
+        for user_id, name, created_at in members.yield_per(500):
+            marks = attended.get(user_id, empty)
+            first = bisect.bisect_left(starts, joined_at_local(created_at))
+            eligible = len(events) - first
+            count = sum(marks[first:])
+            cells = [None] * first + list(marks[first:])
+            stats = attendance_stats(eligible, count)
+            yield [name, member_profession(name)] + cells + [count, eligible, stats['rate']]
+
+    return header, rows()
+
+def stream_csv(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM 讓 Excel 正確辨識 UTF-8 中文
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(['' if cell is None else cell for cell in row])
+        if buffer.tell() > 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def xlsx_row(row):
+    cells = []
+    for cell in row:
+        if cell is None:
+            cells.append('<c/>')
+        elif isinstance(cell, (int, float)):
+            cells.append(f'<c t="n"><v>{cell}</v></c>')
+        else:
+            cells.append(f'<c t="inlineStr"><is><t>{xml_escape(str(cell))}</t></is></c>')
+    return f'<row>{"".join(cells)}</row>'.encode('utf-8')
+
+def stream_xlsx(header, rows):
+    """以 inline string 產生最小的 XLSX，工作表邊寫邊壓縮送出"""
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_STATIC_PARTS.items():
+            archive.writestr(name, content)
+        yield buffer.drain()
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(xlsx_row(header))
+            for row in rows:
+                sheet.write(xlsx_row(row))
+                if len(buffer.chunks) > 16:
+                    yield buffer.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield buffer.drain()
+
+@app.route('/admin/attendance/export')
+def export_attendance_matrix():
+    """匯出日期區間內的成員 × 活動出席矩陣（CSV 或 XLSX），預設為本月"""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    today = date.today()
+    try:
+        start_date = date.fromisoformat(request.args['start']) if request.args.get('start') else today.replace(day=1)
+        end_date = date.fromisoformat(request.args['end']) if request.args.get('end') else today
+    except ValueError:
+        return jsonify({'success': False, 'message': '日期格式應為 YYYY-MM-DD'})
+    if end_date < start_date:
+        return jsonify({'success': False, 'message': '結束日期不能早於開始日期'})
+    
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'xlsx'):
+        return jsonify({'success': False, 'message': '格式只能是 csv 或 xlsx'})
+    
+    if request.args.get('background'):
+        # 大範圍匯出改由背景作業產生檔案，完成後從 /admin/jobs/<id>/download 下載
+        job = enqueue_job('attendance_export', {
+            'start': start_date.isoformat(), 'end': end_date.isoformat(), 'format': export_format
+        })
+        return jsonify({'success': True, 'job_id': job.id, 'message': '已排入背景作業產生匯出檔'})
+    
+    header, rows = attendance_matrix(start_date, end_date)
+    filename = f'attendance_{start_date:%Y%m%d}_{end_date:%Y%m%d}.{export_format}'
+    if export_format == 'xlsx':
+        body = stream_xlsx(header, rows)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        body = stream_csv(header, rows)
+        mimetype = 'text/csv; charset=utf-8'
+    
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"'
+    })
+
+@app.route('/admin/users')
+def admin_users():
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    page, per_page = page_args(default_per_page=50)
+    query = db.session.query(*dto_columns(MemberRow, User))
+    text = request.args.get('q', '').strip()
+    if text:
+        query = search_filter(query, 'user_search', text)
+    rows, pagination = paginate_rows(query.order_by(User.id), page, per_page)
+    
+    return jsonify({'success': True, 'users': [MemberRow(*row) for row in rows], 'pagination': pagination})
+
+@app.route('/admin/users/<int:user_id>')
+def get_user_detail(user_id):
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    row = db.session.query(*dto_columns(MemberDetail, User)).filter(User.id == user_id).first()
+    if not row:
+        return jsonify({'success': False, 'message': '用戶不存在'})
+    
+    return jsonify({'success': True, 'user': MemberDetail(*row)})
+
+@app.route('/admin/checkins')
+def admin_checkins():
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    page, per_page = page_args()
+    history = checkin_history()
+    query = db.session.query(
+        history.c.id, db.func.coalesce(User.name, 'Unknown'), history.c.check_in_time,
+        history.c.check_out_time, history.c.location, history.c.status
+    ).outerjoin(User, User.id == history.c.user_id).order_by(history.c.check_in_time.desc(), history.c.id.desc())
+    rows, pagination = paginate_rows(query, page, per_page)
+    
+    return jsonify({'success': True, 'checkins': [CheckInRow(*row) for row in rows], 'pagination': pagination})
+
+@app.route('/admin/checkins/archive', methods=['POST'])
+def admin_archive_checkins():
+    """把超過保存期限的簽到搬到封存資料庫"""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    days = request.form.get('days', type=int)
+    if days is None:
+        days = (request.get_json(silent=True) or {}).get('days', CHECKIN_ARCHIVE_DAYS)
+    if not isinstance(days, int) or days < 30:
+        return jsonify({'success': False, 'message': '保存期限至少 30 天'})
+    
+    audit('checkins.archive', changes={'days': [None, days]})
+    job = enqueue_job('archive_checkins', {'days': days})
+    return jsonify({'success': True, 'job_id': job.id, 'message': '已排入背景作業封存簽到記錄'})
+
+@app.route('/admin/events/add', methods=['POST'])
+def add_event():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+    
+    # 檢查權限
+    if not has_permission('add_events'):
+        return jsonify({'success': False, 'message': '權限不足，無法新增活動'})
+    
+    try:
+        title = request.form['title']
+        description = request.form['description']
+        start_time = request.form['start_time']
+        end_time = request.form['end_time']
+        location = request.form['location']
+        organizer_id = request.form.get('organizer_id')
+        max_participants = request.form.get('max_participants')
+        
+        if not title or not start_time or not end_time or not location or not organizer_id:
+            return jsonify({'success': False, 'message': '請填寫所有必填欄位'})
+        
+        # 檢查發起人是否存在
+        organizer = db.session.get(User, organizer_id)
+        if not organizer:
+            return jsonify({'success': False, 'message': '發起人不存在'})
+        
+        event = Event(
+            title=title,
+            description=description,
+            location=location,
+            organizer_id=organizer.id,
+            start_time=datetime.fromisoformat(start_time),
+            end_time=datetime.fromisoformat(end_time),
+            max_participants=int(max_participants) if max_participants else 0
+        )
+        
         db.session.add(event)
+        db.session.flush()
+        audit('event.add', 'event', event.id, audit_diff({}, audit_snapshot(event, AUDIT_EVENT_FIELDS)))
+        db.session.commit()
+        return jsonify({'success': True, 'message': '活動新增成功！'})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'新增失敗：{str(e)}'})
+
+# 重複活動設定
+SERIES_FREQUENCIES = {'weekly': '每週', 'biweekly': '每兩週', 'monthly': '每月'}
+SERIES_HORIZON_DAYS = 90  # 預先產生未來多少天的活動實例
+series_state = {'checked_on': {}}  # 各分會上次檢查的日期
+
+def series_horizon():
+    """滾動期間的結束時間，以日為單位前進，避免每個請求都觸發展開"""
+    return datetime.combine(date.today() + timedelta(days=SERIES_HORIZON_DAYS), time.min)
+
+def series_occurrence(series, index):
+    """第 index 次活動的開始時間"""
+    if series.frequency == 'monthly':
+        first = series.first_start
+        month = first.month - 1 + index
+        year = first.year + month // 12
+        month = month % 12 + 1
+        day = min(first.day, calendar.monthrange(year, month)[1])
+        return first.replace(year=year, month=month, day=day)
+    step = 14 if series.frequency == 'biweekly' else 7
+    return series.first_start + timedelta(days=step * index)
+
+def series_occurrences(series, after, until):
+    """列出重複活動在 (after, until] 之間的開始時間，略過例外日期與結束日期之後的場次"""
+    first = series.first_start
+    if series.frequency == 'monthly':
+        index = max(0, (after.year - first.year) * 12 + after.month - first.month - 1)
+    else:
+        step = 14 if series.frequency == 'biweekly' else 7
+        index = max(0, (after - first).days // step - 1)
+
+    exceptions = series.exception_dates()
+    while True:
+        start = series_occurrence(series, index)
+        if start > until or (series.until and start.date() > series.until):
+            return
+        if start > after and start.date().isoformat() not in exceptions:
+            yield start
+        index += 1
+
+def series_event_rows(series, starts):
+    duration = timedelta(minutes=series.duration_minutes)
+    return [{
+        'title': series.title,
+        'description': series.description,
+        'location': series.location,
+        'organizer_id': series.organizer_id,
+        'max_participants': series.max_participants,
+        'start_time': start,
+        'end_time': start + duration,
+        'series_id': series.id
+    } for start in starts]
+
+def materialize_series(series_list, horizon=None):
+    """把重複活動展開到滾動期間結束，所有新實例以單次批次 INSERT 寫入（不提交）"""
+    horizon = horizon or series_horizon()
+    rows = []
+    for series in series_list:
+        after = series.materialized_until
+        if after >= horizon:
+            continue
+        # 以條件式 UPDATE 認領展開區間，避免多個 worker 重複產生同一批實例
+        claimed = db.session.execute(
+            db.update(EventSeries)
+            .where(EventSeries.id == series.id, EventSeries.materialized_until == after)
+            .values(materialized_until=horizon)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if claimed:
+            rows.extend(series_event_rows(series, series_occurrences(series, after, horizon)))
+            series.materialized_until = horizon
+
+    if rows:
+        db.session.execute(db.insert(Event), rows)
+    return len(rows)
+
+def materialize_due_series():
+    """每個 process 每天最多檢查一次是否有重複活動需要展開"""
+    today = date.today()
+    if series_state['checked_on'].get(current_chapter()) == today:
+        return
+    try:
+        horizon = series_horizon()
+        due = EventSeries.query.filter(EventSeries.materialized_until < horizon).all()
+        materialize_series(due, horizon)
+        db.session.commit()
+        series_state['checked_on'][current_chapter()] = today
+    except Exception as e:
+        db.session.rollback()
+        print(f"重複活動展開失敗：{e}")
+
+@app.route('/admin/events/series/add', methods=['POST'])
+def add_event_series():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+    
+    # 檢查權限
+    if not has_permission('add_events'):
+        return jsonify({'success': False, 'message': '權限不足，無法新增活動'})
+    
+    try:
+        title = request.form['title']
+        description = request.form.get('description', '')
+        start_time = request.form['start_time']
+        end_time = request.form['end_time']
+        location = request.form['location']
+        organizer_id = request.form.get('organizer_id')
+        max_participants = request.form.get('max_participants')
+        frequency = request.form.get('frequency')
+        until = request.form.get('until')
+        
+        if not title or not start_time or not end_time or not location or not organizer_id:
+            return jsonify({'success': False, 'message': '請填寫所有必填欄位'})
+        
+        if frequency not in SERIES_FREQUENCIES:
+            return jsonify({'success': False, 'message': '請選擇重複頻率'})
+        
+        # 如果不是管理員，發起人必須是自己
+        if not session.get('is_admin') and organizer_id != str(session['user_id']):
+            return jsonify({'success': False, 'message': '只能將自己設為發起人'})
+        
+        # 檢查發起人是否存在
+        organizer = db.session.get(User, organizer_id)
+        if not organizer:
+            return jsonify({'success': False, 'message': '發起人不存在'})
+        
+        first_start = datetime.fromisoformat(start_time)
+        first_end = datetime.fromisoformat(end_time)
+        if first_end <= first_start:
+            return jsonify({'success': False, 'message': '結束時間必須晚於開始時間'})
+        
+        series = EventSeries(
+            title=title,
+            description=description,
+            location=location,
+            organizer_id=organizer.id,
+            max_participants=int(max_participants) if max_participants else 0,
+            first_start=first_start,
+            duration_minutes=int((first_end - first_start).total_seconds() // 60),
+            frequency=frequency,
+            until=date.fromisoformat(until) if until else None,
+            exceptions=normalize_exception_dates(request.form.get('exceptions', '')),
+            materialized_until=first_start - timedelta(seconds=1)
+        )
+        db.session.add(series)
+        db.session.flush()
+        
+        created = materialize_series([series])
+        audit('event_series.add', 'event_series', series.id, {
+            **audit_diff({}, audit_snapshot(series, AUDIT_SERIES_FIELDS)), 'events_created': [None, created]
+        })
         db.session.commit()
-        return jsonify({'success': True, 'message': '活動新增成功！'})
+        return jsonify({
+            'success': True,
+            'message': f'重複活動新增成功！已建立 {created} 場活動',
+            'series_id': series.id
+        })
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'message': f'新增失敗：{str(e)}'})
 
-@app.route('/admin/events/fix_organizers', methods=['POST'])
-def fix_event_organizers():
-    """修復現有活動的發起人設置"""
-    if 'user_id' not in session or not session.get('is_admin'):
-        return jsonify({'success': False, 'message': '權限不足'})
+def normalize_exception_dates(value):
+    """驗證並整理例外日期字串，格式錯誤時拋出 ValueError"""
+    dates = sorted({date.fromisoformat(part.strip()).isoformat() for part in value.split(',') if part.strip()})
+    return ','.join(dates)
+
+@app.route('/admin/events/series/<int:series_id>/edit', methods=['POST'])
+def edit_event_series(series_id):
+    """修改重複活動，以集合式 UPDATE/DELETE 套用到所有尚未開始的場次"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+    
+    # 檢查權限
+    if not has_permission('edit_events'):
+        return jsonify({'success': False, 'message': '權限不足，無法編輯活動'})
     
     try:
-        # 獲取所有沒有發起人的活動
-        events_without_organizer = Event.query.filter_by(organizer_id=None).all()
+        series = db.session.get(EventSeries, series_id)
+        if not series:
+            return jsonify({'success': False, 'message': '重複活動不存在'})
+        
+        # 如果不是管理員，只能編輯自己發起的活動
+        if not session.get('is_admin') and series.organizer_id != session['user_id']:
+            return jsonify({'success': False, 'message': '只能編輯自己發起的活動'})
+        
+        organizer_id = request.form.get('organizer_id', str(series.organizer_id))
+        if not session.get('is_admin') and organizer_id != str(session['user_id']):
+            return jsonify({'success': False, 'message': '只能將自己設為發起人'})
+        
+        organizer = db.session.get(User, organizer_id)
+        if not organizer:
+            return jsonify({'success': False, 'message': '發起人不存在'})
+        
+        before = audit_snapshot(series, AUDIT_SERIES_FIELDS)
+        max_participants = request.form.get('max_participants')
+        until = request.form.get('until', series.until.isoformat() if series.until else '')
         
-        # 獲取第一個管理員作為默認發起人
-        default_organizer = User.query.filter_by(is_admin=True).first()
+        series.title = request.form.get('title') or series.title
+        series.description = request.form.get('description', series.description)
+        series.location = request.form.get('location') or series.location
+        series.organizer_id = organizer.id
+        if max_participants is not None:
+            series.max_participants = int(max_participants) if max_participants else 0
+        series.until = date.fromisoformat(until) if until else None
+        series.exceptions = normalize_exception_dates(request.form.get('exceptions', series.exceptions or ''))
         
-        if not default_organizer:
-            return jsonify({'success': False, 'message': '沒有找到管理員用戶'})
+        now = datetime.now()
+        upcoming = db.and_(Event.series_id == series.id, Event.start_time >= now)
         
-        # 修復所有沒有發起人的活動
-        for event in events_without_organizer:
-            event.organizer_id = default_organizer.id
+        # 一次更新所有未開始場次的內容
+        updated = db.session.execute(
+            db.update(Event).where(upcoming).values(
+                title=series.title,
+                description=series.description,
+                location=series.location,
+                organizer_id=series.organizer_id,
+                max_participants=series.max_participants
+            ).execution_options(synchronize_session=False)
+        ).rowcount
         
-        db.session.commit()
+        # 刪除落在例外日期或結束日期之後、且尚無人簽到的場次
+        removed_conditions = []
+        if series.exception_dates():
+            removed_conditions.append(db.func.date(Event.start_time).in_(series.exception_dates()))
+        if series.until:
+            removed_conditions.append(db.func.date(Event.start_time) > series.until.isoformat())
+        removed = dropped = 0
+        removed_ids = []
+        if removed_conditions:
+            removed_ids = db.session.execute(
+                db.select(Event.id).where(
+                    upcoming,
+                    db.or_(*removed_conditions),
+                    ~db.exists().where(CheckIn.event_id == Event.id)
+                )
+            ).scalars().all()
+            if removed_ids:
+                # 與刪除單一活動相同，一併刪除這些場次的報名、提醒與到場曲線
+                for model in (EventRegistration, Reminder, ArrivalCurve):
+                    deleted = db.session.execute(
+                        db.delete(model).where(model.event_id.in_(removed_ids)).execution_options(synchronize_session=False)
+                    ).rowcount
+                    if model is EventRegistration:
+                        dropped = deleted
+                removed = db.session.execute(
+                    db.delete(Event).where(Event.id.in_(removed_ids)).execution_options(synchronize_session=False)
+                ).rowcount
         
+        # 人數上限提高後，候補成員依序遞補各場次空出的名額
+        waitlisted = db.exists().where(EventRegistration.event_id == Event.id, EventRegistration.status == 'waitlisted')
+        promoted = 0
+        for event in Event.query.filter(upcoming, waitlisted).populate_existing():
+            promoted += fill_from_waitlist(event)
+        
+        # 補上因取消例外日期或延長結束日期而缺少的場次
+        existing = {start for (start,) in db.session.query(Event.start_time).filter(upcoming)}
+        horizon = max(series.materialized_until, series_horizon())
+        missing = [start for start in series_occurrences(series, now, horizon) if start not in existing]
+        if missing:
+            db.session.execute(db.insert(Event), series_event_rows(series, missing))
+        series.materialized_until = horizon
+        
+        # 場次與報名的變動和欄位變動記在同一筆稽核
+        changes = audit_diff(before, audit_snapshot(series, AUDIT_SERIES_FIELDS))
+        effects = {
+            'events_updated': updated,
+            'events_removed': removed_ids,
+            'events_created': len(missing),
+            'registrations_dropped': dropped,
+            'registrations_promoted': promoted
+        }
+        changes.update({key: [None, value] for key, value in effects.items() if value})
+        audit('event_series.edit', 'event_series', series.id, changes)
+        db.session.commit()
         return jsonify({
-            'success': True, 
-            'message': f'已修復 {len(events_without_organizer)} 個活動的發起人設置'
+            'success': True,
+            'message': f'重複活動更新成功！更新 {updated} 場、移除 {removed} 場、新增 {len(missing)} 場'
         })
-        
     except Exception as e:
         db.session.rollback()
-        return jsonify({'success': False, 'message': f'修復失敗：{str(e)}'})
+        return jsonify({'success': False, 'message': f'更新活動失敗：{str(e)}'})
+
+@app.route('/admin/events/fix_organizers', methods=['POST'])
+def fix_event_organizers():
+    """修復現有活動的發起人設置"""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    if not User.query.filter_by(is_admin=True).first():
+        return jsonify({'success': False, 'message': '沒有找到管理員用戶'})
+    
+    audit('event.fix_organizers')
+    job = enqueue_job('fix_event_organizers')
+    return jsonify({'success': True, 'job_id': job.id, 'message': '已排入背景作業修復活動發起人'})
 
 @app.route('/admin/events/edit/<int:event_id>', methods=['POST'])
 def admin_edit_event(event_id):
@@ -731,13 +2839,16 @@ def admin_edit_event(event_id):
             return jsonify({'success': False, 'message': '只能將自己設為發起人'})
         
         # 更新活動
+        before = audit_snapshot(event, AUDIT_EVENT_FIELDS)
         event.title = title
         event.description = description
         event.location = location
-        event.organizer_id = organizer_id  # 新增：更新發起人
+        event.organizer_id = organizer.id  # 新增：更新發起人
         event.start_time = datetime.fromisoformat(start_time)
         event.end_time = datetime.fromisoformat(end_time)
         event.max_participants = int(max_participants) if max_participants else 0 # 新增：更新參與人數限制
+        audit('event.edit', 'event', event.id, audit_diff(before, audit_snapshot(event, AUDIT_EVENT_FIELDS)))
+        fill_from_waitlist(event)
         
         db.session.commit()
         return jsonify({'success': True, 'message': '活動更新成功！'})
@@ -764,10 +2875,23 @@ def admin_delete_event(event_id):
         if not session.get('is_admin') and event.organizer_id != session['user_id']:
             return jsonify({'success': False, 'message': '只能刪除自己發起的活動'})
         
-        # 刪除相關的簽到記錄
+        # 刪除相關的簽到與報名記錄
         CheckIn.query.filter_by(event_id=event_id).delete()
+        ArchivedCheckIn.query.filter_by(event_id=event_id).delete()
+        EventRegistration.query.filter_by(event_id=event_id).delete()
+        Reminder.query.filter_by(event_id=event_id).delete()
+        ArrivalCurve.query.filter_by(event_id=event_id).delete()
+        
+        # 刪除重複活動的單一場次時記為例外日期，避免之後重新產生
+        if event.series_id:
+            series = db.session.get(EventSeries, event.series_id)
+            if series:
+                series.exceptions = normalize_exception_dates(
+                    f"{series.exceptions or ''},{event.start_time.date().isoformat()}"
+                )
         
         # 刪除活動
+        audit('event.delete', 'event', event.id, audit_diff(audit_snapshot(event, AUDIT_EVENT_FIELDS), {}))
         db.session.delete(event)
         db.session.commit()
         
@@ -808,20 +2932,145 @@ def add_user():
             phone=phone,
             line_id=line_id,
             position=position,
-            can_add_events='can_add_events' in request.form,
-            can_edit_events='can_edit_events' in request.form,
-            can_delete_events='can_delete_events' in request.form,
-            can_manage_users='can_manage_users' in request.form,
+            permissions=permission_mask(request.form),
             is_admin=False
         )
         
         db.session.add(user)
+        db.session.flush()
+        audit('user.add', 'user', user.id, audit_diff({}, audit_snapshot(user, AUDIT_USER_FIELDS)))
         db.session.commit()
         return jsonify({'success': True, 'message': '用戶新增成功'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'message': f'新增失敗：{str(e)}'})
 
+# 批次匯入成員
+IMPORT_ROW_LIMIT = 1000
+IMPORT_FIELDS = ('username', 'password', 'name', 'email', 'phone', 'line_id', 'position')
+IMPORT_PERMISSIONS = tuple(PERMISSION_FIELDS)
+IMPORT_TRUE_VALUES = ('1', 'true', 'yes', 'y', '是', 'v')
+
+def valid_member_name(name):
+    """姓名必須是「編號/姓名/專業別」三段且皆不為空"""
+    parts = name.split('/')
+    return len(parts) == 3 and all(part.strip() for part in parts)
+
+def read_import_rows():
+    """從上傳的 CSV/JSON 檔或 JSON 內容讀出成員資料列"""
+    upload = request.files.get('file')
+    if upload and upload.filename:
+        content = upload.read().decode('utf-8-sig')
+        if upload.filename.lower().endswith('.json'):
+            data = json.loads(content)
+            return data.get('users', []) if isinstance(data, dict) else data
+        return list(csv.DictReader(io.StringIO(content)))
+    data = request.get_json(silent=True) or {}
+    return data.get('users', [])
+
+def validate_import_rows(raw_rows):
+    """逐列檢查格式，用戶名衝突以單一 IN 查詢比對；回傳 (報告, 可寫入的資料列)"""
+    report, candidates, seen = [], [], {}
+    for index, raw in enumerate(raw_rows, start=1):
+        if not isinstance(raw, dict):
+            report.append({'row': index, 'username': None, 'status': 'error', 'errors': ['資料格式錯誤']})
+            continue
+        row = {field: str(raw.get(field) or '').strip() for field in IMPORT_FIELDS}
+        errors = []
+        if not row['username']:
+            errors.append('缺少用戶名')
+        elif row['username'] in seen:
+            errors.append(f'與第 {seen[row["username"]]} 列用戶名重複')
+        else:
+            seen[row['username']] = index
+        if not row['password']:
+            errors.append('缺少密碼')
+        if not valid_member_name(row['name']):
+            errors.append('姓名格式錯誤，請使用「編號/姓名/專業別」格式')
+        if row['position'] and row['position'] not in POSITION_RANK:
+            errors.append(f'職級「{row["position"]}」不存在')
+        for permission in IMPORT_PERMISSIONS:
+            row[permission] = str(raw.get(permission) or '').strip().lower() in IMPORT_TRUE_VALUES
+        report.append({'row': index, 'username': row['username'] or None, 'status': 'error' if errors else 'valid', 'errors': errors})
+        candidates.append((report[-1], row))
+
+    usernames = [row['username'] for entry, row in candidates if entry['status'] == 'valid']
+    existing = {username for (username,) in db.session.query(User.username).filter(User.username.in_(usernames))} if usernames else set()
+
+    rows = []
+    for entry, row in candidates:
+        if entry['status'] != 'valid':
+            continue
+        if row['username'] in existing:
+            entry['status'] = 'error'
+            entry['errors'].append('用戶名已存在')
+            continue
+        rows.append((entry, row))
+    return report, rows
+
+def hash_passwords(passwords):
+    """密碼雜湊是 CPU 密集的 scrypt，底層會釋放 GIL，可以用執行緒平行計算"""
+    if len(passwords) < 2:
+        return [generate_password_hash(password) for password in passwords]
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1, len(passwords))) as executor:
+        return list(executor.map(generate_password_hash, passwords))
+
+@app.route('/admin/users/import', methods=['POST'])
+def import_users():
+    """以 CSV 或 JSON 批次新增成員，回傳逐列結果；dry_run 只檢查不寫入"""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    try:
+        raw_rows = read_import_rows()
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'success': False, 'message': f'無法讀取匯入檔案：{str(e)}'})
+    if not isinstance(raw_rows, list) or not raw_rows:
+        return jsonify({'success': False, 'message': '沒有可匯入的成員資料'})
+    if len(raw_rows) > IMPORT_ROW_LIMIT:
+        return jsonify({'success': False, 'message': f'一次最多匯入 {IMPORT_ROW_LIMIT} 位成員'})
+    
+    data = request.get_json(silent=True) or {}
+    dry_run = str(request.values.get('dry_run', data.get('dry_run', ''))).lower() in IMPORT_TRUE_VALUES
+    
+    report, rows = validate_import_rows(raw_rows)
+    if rows and not dry_run:
+        hashes = hash_passwords([row['password'] for _, row in rows])
+        values = []
+        for (entry, row), password_hash in zip(rows, hashes):
+            values.append({
+                'username': row['username'],
+                'password_hash': password_hash,
+                'name': row['name'],
+                'email': row['email'] or None,
+                'phone': row['phone'] or None,
+                'line_id': row['line_id'] or None,
+                'position': row['position'] or None,
+                'is_admin': False,
+                'permissions': permission_mask(permission for permission in IMPORT_PERMISSIONS if row[permission])
+            })
+        try:
+            db.session.execute(db.insert(User), values)
+            audit('user.import', changes={'usernames': [None, [row['username'] for row in values]]})
+            db.session.commit()
+        except IntegrityError:
+            # 檢查後才被其他請求建立的用戶名，整批不寫入，請重新匯入
+            db.session.rollback()
+            return jsonify({'success': False, 'message': '匯入期間用戶名被佔用，請重新匯入', 'report': report})
+        for entry, _ in rows:
+            entry['status'] = 'created'
+    
+    failed = sum(1 for entry in report if entry['status'] == 'error')
+    return jsonify({
+        'success': True,
+        'dry_run': dry_run,
+        'message': f'{"可匯入" if dry_run else "已匯入"} {len(rows)} 位成員，{failed} 列有錯誤',
+        'created': 0 if dry_run else len(rows),
+        'valid': len(rows),
+        'failed': failed,
+        'report': report
+    })
+
 @app.route('/admin/users/edit/<int:user_id>', methods=['POST'])
 def edit_user(user_id):
     if 'user_id' not in session or not session.get('is_admin'):
@@ -833,6 +3082,7 @@ def edit_user(user_id):
     
     try:
         # 用戶名不應該被修改，所以不從表單獲取
+        before = audit_snapshot(user, AUDIT_USER_FIELDS)
         user.name = request.form['name']
         user.email = request.form['email']
         user.phone = request.form['phone']
@@ -840,10 +3090,7 @@ def edit_user(user_id):
         user.position = request.form['position']
         
         # 處理權限設定
-        user.can_add_events = 'can_add_events' in request.form
-        user.can_edit_events = 'can_edit_events' in request.form
-        user.can_delete_events = 'can_delete_events' in request.form
-        user.can_manage_users = 'can_manage_users' in request.form
+        user.permissions = permission_mask(request.form)
         
         # 檢查姓名格式
         if '/' not in user.name:
@@ -854,12 +3101,43 @@ def edit_user(user_id):
         if new_password:
             user.password_hash = generate_password_hash(new_password)
         
+        changes = audit_diff(before, audit_snapshot(user, AUDIT_USER_FIELDS))
+        if new_password:
+            changes['password'] = [None, '已變更']  # 不記錄密碼內容
+        audit('user.edit', 'user', user.id, changes)
         db.session.commit()
         return jsonify({'success': True, 'message': '用戶更新成功'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'message': f'更新失敗：{str(e)}'})
 
+@app.route('/admin/users/grant', methods=['POST'])
+def grant_role():
+    """將職級與其預設權限授予多位成員，以單一 UPDATE 完成（原有權限保留）"""
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    data = request.get_json(silent=True) or {}
+    role = data.get('role')
+    if role not in ROLE_PRESETS:
+        return jsonify({'success': False, 'message': '職級不存在'})
+    try:
+        user_ids = sorted({int(user_id) for user_id in data.get('user_ids', [])})
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '成員編號格式錯誤'})
+    if not user_ids:
+        return jsonify({'success': False, 'message': '請選擇成員'})
+    
+    result = db.session.execute(
+        db.update(User).where(User.id.in_(user_ids)).values(
+            position=role,
+            permissions=User.permissions.op('|')(ROLE_PRESETS[role])
+        ).execution_options(synchronize_session=False)
+    )
+    audit('user.grant', changes={'role': [None, role], 'user_ids': [None, user_ids]})
+    db.session.commit()
+    return jsonify({'success': True, 'message': f'已將「{role}」授予 {result.rowcount} 位成員', 'updated': result.rowcount})
+
 @app.route('/admin/users/delete/<int:user_id>', methods=['POST'])
 def admin_delete_user(user_id):
     if 'user_id' not in session or not session.get('is_admin'):
@@ -874,14 +3152,10 @@ def admin_delete_user(user_id):
         if user.id == session['user_id']:
             return jsonify({'success': False, 'message': '不能刪除自己的帳號'})
         
-        # 刪除相關的簽到記錄
-        CheckIn.query.filter_by(user_id=user_id).delete()
-        
-        # 刪除用戶
-        db.session.delete(user)
-        db.session.commit()
-        
-        return jsonify({'success': True, 'message': '成員刪除成功！'})
+        # 多年的簽到與報名記錄可能很多，交給背景作業刪除；實際刪除由作業成功時記錄 user.delete
+        audit('user.delete.requested', 'user', user.id, audit_diff(audit_snapshot(user, AUDIT_USER_FIELDS), {}))
+        job = enqueue_job('delete_user', {'user_id': user_id})
+        return jsonify({'success': True, 'job_id': job.id, 'message': '已排入背景作業刪除成員'})
         
     except Exception as e:
         db.session.rollback()
@@ -904,7 +3178,7 @@ def upload_avatar():
             # 生成安全的檔案名
             filename = secure_filename(file.filename)
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{session['user_id']}_{timestamp}_{filename}"
+            filename = chapter_scoped(f"{session['user_id']}_{timestamp}_{filename}", '_')
             
             # 確保 avatars 目錄存在
             avatar_dir = os.path.join(app.static_folder, 'avatars')
@@ -940,49 +3214,884 @@ def get_user_avatar(user_id):
     if 'user_id' not in session:
         return jsonify({'success': False, 'message': '請先登入'})
     
+    row = db.session.query(*dto_columns(MemberCard, User)).filter(User.id == user_id).first()
+    if not row:
+        return jsonify({'success': False, 'message': '用戶不存在'})
+    
+    return jsonify({'success': True, 'card': MemberCard(*row)})
+
+MEMBER_CARD_BATCH_LIMIT = 500
+
+@app.route('/api/users/cards')
+def member_cards():
+    """批次取得成員卡片（ids=1,2,3）
+
+    ETag 由分會、成員世代與 ID 清單組成，不需要查詢就能算出；瀏覽器帶著 If-None-Match 重新驗證時，
+    成員資料未變動就直接回 304，不查詢資料表。
+    """
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '請先登入'})
+    
+    try:
+        user_ids = sorted({int(value) for value in request.args.get('ids', '').split(',') if value.strip()})
+    except ValueError:
+        return jsonify({'success': False, 'message': '成員編號格式錯誤'})
+    if len(user_ids) > MEMBER_CARD_BATCH_LIMIT:
+        return jsonify({'success': False, 'message': f'一次最多取得 {MEMBER_CARD_BATCH_LIMIT} 位成員'})
+    
+    etag = hashlib.sha1(f'{current_chapter()}:{cache_generation("users")}:{user_ids}'.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        rows = db.session.query(*dto_columns(MemberCard, User)).filter(User.id.in_(user_ids)).all() if user_ids else []
+        response = jsonify({'success': True, 'cards': [MemberCard(*row) for row in rows]})
+    response.set_etag(etag)
+    # 每次使用前都向伺服器確認，資料未變時只多一個 304
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# 稽核紀錄
+# 紀錄隨目前交易提交後放入記憶體緩衝區，由背景執行緒批次寫入，請求本身不會多一次提交。
+# 程序異常終止時尚未寫入的紀錄會遺失（正常結束時會先寫入）。
+AUDIT_BATCH_SIZE = 200
+AUDIT_FLUSH_INTERVAL = 2  # 秒
+AUDIT_USER_FIELDS = ('name', 'email', 'phone', 'line_id', 'position', 'is_admin', 'permissions')
+AUDIT_EVENT_FIELDS = ('title', 'description', 'location', 'organizer_id', 'start_time', 'end_time', 'max_participants')
+AUDIT_SERIES_FIELDS = ('title', 'description', 'location', 'organizer_id', 'max_participants', 'first_start',
+                       'duration_minutes', 'frequency', 'until', 'exceptions')
+audit_buffer = deque()
+audit_state = {'pid': None, 'wakeup': threading.Event()}
+audit_lock = threading.Lock()
+
+def audit_snapshot(obj, columns):
+    return {column: getattr(obj, column) for column in columns}
+
+def audit_diff(before, after):
+    """只保留有變動的欄位，{欄位: [變更前, 變更後]}"""
+    return {key: [before.get(key), after.get(key)] for key in {**before, **after} if before.get(key) != after.get(key)}
+
+def audit(action, target_type=None, target_id=None, changes=None):
+    """記錄一筆稽核；交易提交後才會放入緩衝區，回滾時一併捨棄"""
+    in_request = has_request_context()
+    db.session.info.setdefault('audit_pending', []).append({
+        'actor_id': session.get('user_id') if in_request else None,
+        'actor_name': session.get('name') if in_request else None,
+        'action': action,
+        'target_type': target_type,
+        'target_id': target_id,
+        'changes': json.dumps(changes, ensure_ascii=False, default=str) if changes else None,
+        'ip': request.remote_addr if in_request else None,
+        'created_at': datetime.utcnow()
+    })
+
+@sa_event.listens_for(Session, 'after_commit')
+def queue_audit_entries(session):
+    entries = session.info.pop('audit_pending', None)
+    if entries:
+        audit_buffer.extend((current_chapter(), entry) for entry in entries)
+        start_audit_writer()
+        if len(audit_buffer) >= AUDIT_BATCH_SIZE:
+            audit_state['wakeup'].set()
+
+@sa_event.listens_for(Session, 'after_rollback')
+def discard_audit_entries(session):
+    session.info.pop('audit_pending', None)
+
+def start_audit_writer():
+    """每個程序各自啟動寫入執行緒；gunicorn fork 後的 worker 會重新啟動"""
+    if audit_state['pid'] == os.getpid():
+        return
+    with audit_lock:
+        if audit_state['pid'] != os.getpid():
+            audit_state['pid'] = os.getpid()
+            threading.Thread(target=audit_writer, daemon=True).start()
+
+def audit_writer():
+    while True:
+        audit_state['wakeup'].wait(AUDIT_FLUSH_INTERVAL)
+        audit_state['wakeup'].clear()
+        flush_audit()
+
+def flush_audit():
+    """把緩衝區的紀錄依分會以 executemany 分批寫入；失敗時放回緩衝區下次重試"""
+    while audit_buffer:
+        batch = []
+        while audit_buffer and len(batch) < AUDIT_BATCH_SIZE:
+            batch.append(audit_buffer.popleft())
+        by_chapter = {}
+        for chapter, entry in batch:
+            by_chapter.setdefault(chapter, []).append(entry)
+        failed = []
+        with app.app_context():
+            for chapter, rows in by_chapter.items():
+                with chapter_context(chapter):
+                    try:
+                        db.session.execute(db.insert(AuditLog), rows)
+                        db.session.commit()
+                    except Exception as e:
+                        db.session.rollback()
+                        failed.extend((chapter, row) for row in rows)
+                        print(f"稽核紀錄寫入失敗：{e}")
+        if failed:
+            audit_buffer.extendleft(reversed(failed))
+            return
+
+atexit.register(flush_audit)
+
+@app.route('/admin/audit')
+def admin_audit():
+    """稽核紀錄查詢，依 ID 由新到舊以 keyset 分頁（before=上一頁最後一筆的 ID）
+
+    其他 worker 緩衝中的紀錄最多延遲 AUDIT_FLUSH_INTERVAL 秒才會出現。
+    """
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    flush_audit()
+    _, per_page = page_args(default_per_page=50)
+    query = db.session.query(*dto_columns(AuditEntry, AuditLog))
+    before = request.args.get('before', type=int)
+    if before:
+        query = query.filter(AuditLog.id < before)
+    actor_id = request.args.get('actor_id', type=int)
+    if actor_id:
+        query = query.filter(AuditLog.actor_id == actor_id)
+    action = request.args.get('action')
+    if action:
+        query = query.filter(AuditLog.action == action)
+    target_type = request.args.get('target_type')
+    if target_type:
+        query = query.filter(AuditLog.target_type == target_type)
+        target_id = request.args.get('target_id', type=int)
+        if target_id:
+            query = query.filter(AuditLog.target_id == target_id)
+    
+    rows = query.order_by(AuditLog.id.desc()).limit(per_page + 1).all()
+    entries = [
+        AuditEntry(**{**row._mapping, 'changes': json.loads(row.changes) if row.changes else None})
+        for row in rows[:per_page]
+    ]
+    next_before = entries[-1].id if len(rows) > per_page else None
+    return jsonify({'success': True, 'entries': entries, 'next_before': next_before})
+
+# 背景作業
+JOB_HANDLERS = {}
+JOB_LOCK_TIMEOUT = timedelta(minutes=15)  # 執行中超過此時間視為 worker 已中斷
+JOB_WORKER_LOCK = os.environ.get('JOB_WORKER_LOCK')  # 內嵌 worker 的檔案鎖，預設放在資料庫旁
+JOB_RETRY_DELAY = 30  # 秒，每次重試加倍
+EXPORT_FOLDER = os.path.join(app.instance_path, 'exports')
+
+def job_handler(kind):
+    """註冊背景作業處理函數；處理函數需可重複執行，重試時會從頭再跑一次"""
+    def register(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return register
+
+def enqueue_job(kind, payload=None, max_attempts=3):
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload or {}, ensure_ascii=False),
+        max_attempts=max_attempts,
+        created_by=session.get('user_id') if has_request_context() else None
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def report_progress(job, progress, message=None):
+    """更新進度並提交目前交易，處理函數只在資料一致的檢查點呼叫"""
+    job.progress = max(0, min(100, int(progress)))
+    if message:
+        job.message = message
+    db.session.commit()
+
+def claim_job():
+    """以單一條件式 UPDATE 取得下一個可執行的作業，多個 worker 不會重複領取"""
+    now = datetime.utcnow()
+    stale = now - JOB_LOCK_TIMEOUT
+    # SQLite 的 UPDATE 即使沒有符合的資料列也要取得寫入鎖，先以 SELECT 確認有需要處理的作業
+    abandoned = db.and_(Job.status == 'running', Job.locked_at < stale, Job.attempts >= Job.max_attempts)
+    if db.session.query(db.select(Job.id).where(abandoned).exists()).scalar():
+        # 中斷的 worker 已用完重試次數的作業直接標記失敗
+        db.session.execute(db.update(Job).where(abandoned).values(
+            status='failed', message='worker 中斷且已達重試上限', finished_at=now
+        ))
+        db.session.commit()
+    claimable = db.or_(
+        db.and_(Job.status == 'queued', Job.run_after <= now),
+        db.and_(Job.status == 'running', Job.locked_at < stale)
+    )
+    candidate = db.session.execute(
+        db.select(Job.id).where(claimable).order_by(Job.run_after, Job.id).limit(1)
+    ).scalar()
+    if candidate is None:
+        db.session.rollback()
+        return None
+    # 條件式 UPDATE 仍再檢查一次，其他 worker 搶先領取時不會更新
+    job_id = db.session.execute(db.update(Job).where(Job.id == candidate, claimable).values(
+        status='running', locked_at=now, attempts=Job.attempts + 1
+    ).returning(Job.id)).scalar()
+    db.session.commit()
+    return job_id
+
+def run_job(job_id):
+    job = db.session.get(Job, job_id)
+    handler = JOB_HANDLERS.get(job.kind)
+    try:
+        if not handler:
+            raise LookupError(f'未知的作業類型：{job.kind}')
+        result = handler(job, json.loads(job.payload or '{}'))
+        job.status = 'succeeded'
+        job.progress = 100
+        job.result = json.dumps(result, ensure_ascii=False) if result is not None else None
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.message = str(e)[:500]
+        if handler and job.attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_after = datetime.utcnow() + timedelta(seconds=JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+        else:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+        db.session.commit()
+        print(f"背景作業 {job.id}（{job.kind}）失敗：{e}")
+
+def run_worker(poll_interval=2.0, once=False, stop=None):
+    """worker 主迴圈，輪流處理各分會的佇列；once=True 時處理完目前佇列就結束
+
+    stop 為 threading.Event 時，設定後處理完目前的作業就結束。
+    """
+    init_db()
+    with app.app_context():
+        while stop is None or not stop.is_set():
+            worked = False
+            for slug in CHAPTERS:
+                with chapter_context(slug):
+                    try:
+                        reminder_tick()
+                        job_id = claim_job()
+                        if job_id:
+                            run_job(job_id)
+                            worked = True
+                    except Exception as e:
+                        db.session.rollback()
+                        print(f"背景作業 worker 錯誤（{slug}）：{e}")
+            if not worked:
+                if once:
+                    return
+                if stop is not None:
+                    stop.wait(poll_interval)
+                else:
+                    time_module.sleep(poll_interval)
+
+def run_embedded_worker(stop, retry_interval=5.0):
+    """web worker 內的背景作業迴圈：只有取得檔案鎖的程序執行
+
+    其他 web worker 每隔 retry_interval 秒以非阻塞方式重試，持有者結束（例如 max_requests 重啟）時由其中一個接手，
+    任何時候只有一個迴圈在輪詢資料庫。不能阻塞在 flock 上：gevent 下執行緒是協程，會卡住整個 worker。
+    """
+    with open(JOB_WORKER_LOCK or os.path.join(database_folder(), 'job_worker.lock'), 'a') as lock:
+        while not stop.is_set():
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                stop.wait(retry_interval)
+                continue
+            run_worker(stop=stop)
+
+def job_dict(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'message': job.message,
+        'result': json.loads(job.result) if job.result else None,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'created_at': job.created_at.strftime('%Y-%m-%d %H:%M:%S') if job.created_at else None,
+        'finished_at': job.finished_at.strftime('%Y-%m-%d %H:%M:%S') if job.finished_at else None
+    }
+
+@job_handler('delete_user')
+def delete_user_job(job, payload):
+    user_id = payload['user_id']
     user = db.session.get(User, user_id)
     if not user:
-        return jsonify({'success': False, 'message': '用戶不存在'})
+        return {'deleted': False}
     
-    return jsonify({
-        'success': True,
-        'avatar': user.avatar,
-        'name': user.name,
-        'email': user.email,
-        'phone': user.phone,
-        'line_id': user.line_id,
-        'position': user.position  # 新增：職級
+    # 扣除活動簽到人數快取，並刪除相關的簽到記錄
+    history = checkin_history()
+    attended = db.session.query(history.c.event_id, db.func.count()).filter(
+        history.c.user_id == user_id,
+        history.c.event_id.isnot(None)
+    ).group_by(history.c.event_id).all()
+    add_attended_counts({event_id: -count for event_id, count in attended})
+    CheckIn.query.filter_by(user_id=user_id).delete()
+    ArchivedCheckIn.query.filter_by(user_id=user_id).delete()
+    report_progress(job, 50, '已刪除簽到記錄')
+    
+    # 釋出報名名額（候補成員依序遞補），再刪除報名記錄
+    for registration in EventRegistration.query.filter(
+        EventRegistration.user_id == user_id,
+        EventRegistration.status.in_(['registered', 'waitlisted'])
+    ).all():
+        cancel_registration(registration)
+    EventRegistration.query.filter_by(user_id=user_id).delete()
+    Reminder.query.filter_by(user_id=user_id).delete()
+    
+    # 刪除用戶，稽核與刪除在同一交易提交
+    name = user.name
+    audit('user.delete', 'user', user_id, audit_diff(audit_snapshot(user, AUDIT_USER_FIELDS), {}))
+    db.session.delete(user)
+    db.session.commit()
+    job.message = f'已刪除成員 {name}'
+    return {'deleted': True, 'name': name}
+
+@job_handler('fix_event_organizers')
+def fix_event_organizers_job(job, payload):
+    # 獲取第一個管理員作為默認發起人
+    default_organizer = User.query.filter_by(is_admin=True).order_by(User.id).first()
+    if not default_organizer:
+        raise LookupError('沒有找到管理員用戶')
+    
+    fixed = db.session.execute(db.update(Event).where(Event.organizer_id.is_(None)).values(
+        organizer_id=default_organizer.id
+    ).execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    job.message = f'已修復 {fixed} 個活動的發起人設置'
+    return {'fixed': fixed}
+
+@job_handler('archive_checkins')
+def archive_checkins_job(job, payload):
+    moved = archive_checkins(payload.get('days'))
+    job.message = f'已封存 {moved} 筆簽到記錄'
+    return {'archived': moved}
+
+@job_handler('attendance_export')
+def attendance_export_job(job, payload):
+    start_date = date.fromisoformat(payload['start'])
+    end_date = date.fromisoformat(payload['end'])
+    export_format = payload['format']
+    header, rows = attendance_matrix(start_date, end_date)
+    body = stream_xlsx(header, rows) if export_format == 'xlsx' else stream_csv(header, rows)
+    
+    os.makedirs(EXPORT_FOLDER, exist_ok=True)
+    filename = f'attendance_{start_date:%Y%m%d}_{end_date:%Y%m%d}.{export_format}'
+    stored = chapter_scoped(f'job_{job.id}_{filename}', '_')
+    with open(os.path.join(EXPORT_FOLDER, stored), 'wb') as output:
+        for chunk in body:
+            output.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+    return {'filename': filename, 'file': stored}
+
+# 活動提醒
+REMINDER_LEAD = timedelta(hours=int(os.environ.get('REMINDER_LEAD_HOURS', 24)))  # 活動開始前多久提醒
+REMINDER_SCAN_INTERVAL = 60  # 秒，worker 多久檢查一次是否有活動需要排程提醒
+REMINDER_BATCH_SIZE = int(os.environ.get('REMINDER_BATCH_SIZE', 50))  # 每次交給傳送方式的收件人數
+REMINDER_CONCURRENCY = int(os.environ.get('REMINDER_CONCURRENCY', 4))  # 同時傳送的批次數
+REMINDER_MAX_ATTEMPTS = 5
+REMINDER_RETRY_DELAY = 60  # 秒，每次重試加倍
+reminder_state = {'next_scan': {}}  # 各分會下次檢查的時間
+
+class SmtpTransport:
+    """以 SMTP 寄送 email 提醒，每個批次共用一條連線"""
+
+    def __init__(self, host, port, sender, username=None, password=None, starttls=False):
+        self.host, self.port, self.sender = host, port, sender
+        self.username, self.password, self.starttls = username, password, starttls
+
+    def send(self, subject, body, recipients):
+        """recipients 為 [(reminder_id, 地址)]，回傳 {reminder_id: 錯誤訊息或 None}"""
+        results = {}
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            for reminder_id, address in recipients:
+                message = EmailMessage()
+                message['Subject'], message['From'], message['To'] = subject, self.sender, address
+                message.set_content(body)
+                try:
+                    smtp.send_message(message)
+                    results[reminder_id] = None
+                except smtplib.SMTPException as e:
+                    results[reminder_id] = str(e)
+        return results
+
+class LineTransport:
+    """以 LINE Messaging API 的 multicast 寄送提醒，同一則訊息一次送給整批收件人"""
+
+    def __init__(self, token, api_url='https://api.line.me/v2/bot/message/multicast'):
+        self.token, self.api_url = token, api_url
+
+    def send(self, subject, body, recipients):
+        payload = json.dumps({
+            'to': [address for _, address in recipients],
+            'messages': [{'type': 'text', 'text': f'{subject}\n{body}'}]
+        }).encode()
+        api_request = urllib.request.Request(self.api_url, data=payload, method='POST', headers={
+            'Content-Type': 'application/json', 'Authorization': f'Bearer {self.token}'
+        })
+        with urllib.request.urlopen(api_request, timeout=30):
+            pass
+        return {reminder_id: None for reminder_id, _ in recipients}
+
+def reminder_transports():
+    """依環境變數啟用傳送方式；沒有設定的管道不會排程提醒"""
+    transports = {}
+    if os.environ.get('SMTP_HOST'):
+        transports['email'] = SmtpTransport(
+            os.environ['SMTP_HOST'], int(os.environ.get('SMTP_PORT', 25)),
+            os.environ.get('SMTP_SENDER', 'noreply@localhost'),
+            os.environ.get('SMTP_USERNAME'), os.environ.get('SMTP_PASSWORD'),
+            os.environ.get('SMTP_STARTTLS') == '1'
+        )
+    if os.environ.get('LINE_CHANNEL_TOKEN'):
+        transports['line'] = LineTransport(
+            os.environ['LINE_CHANNEL_TOKEN'],
+            os.environ.get('LINE_API_URL', 'https://api.line.me/v2/bot/message/multicast')
+        )
+    return transports
+
+REMINDER_ADDRESSES = {'email': User.email, 'line': User.line_id}
+
+def schedule_reminders(now=None, transports=None):
+    """為即將開始的活動建立提醒，每個管道以單一 INSERT ... SELECT 寫入，已排程者由唯一索引略過
+
+    有報名制的活動（設有名額或已有人報名）只提醒已報名成員，其他活動提醒所有成員。
+    先以 EXISTS 確認有尚未排程的提醒才寫入，閒置時不會取得 SQLite 的寫入鎖。
+    回傳新建立的提醒數。
+    """
+    now = now or datetime.now()
+    transports = reminder_transports() if transports is None else transports
+    registered = db.exists().where(
+        EventRegistration.event_id == Event.id,
+        EventRegistration.user_id == User.id,
+        EventRegistration.status == 'registered'
+    )
+    open_event = db.and_(Event.max_participants == 0, Event.registered_count == 0)
+    created = 0
+    for channel, address in REMINDER_ADDRESSES.items():
+        if channel not in transports:
+            continue
+        rows = db.select(Event.id, User.id, db.literal(channel), address, db.literal(datetime.utcnow())).select_from(
+            Event
+        ).join(User, db.true()).where(
+            Event.start_time > now,
+            Event.start_time <= now + REMINDER_LEAD,
+            address.isnot(None), address != '',
+            db.or_(open_event, registered)
+        )
+        scheduled = db.exists().where(
+            Reminder.event_id == Event.id, Reminder.user_id == User.id, Reminder.channel == channel
+        )
+        if not db.session.query(rows.where(~scheduled).exists()).scalar():
+            continue
+        statement = sqlite_insert(Reminder).from_select(
+            ['event_id', 'user_id', 'channel', 'address', 'next_attempt_at'], rows
+        ).on_conflict_do_nothing()
+        created += db.session.execute(statement).rowcount
+        db.session.commit()
+    return created
+
+def reminder_tick():
+    """由 worker 迴圈定期呼叫：排程新提醒，有待寄送的提醒且沒有寄送作業在排隊時建立一個"""
+    chapter = current_chapter()
+    if time_module.monotonic() < reminder_state['next_scan'].get(chapter, 0):
+        return
+    reminder_state['next_scan'][chapter] = time_module.monotonic() + REMINDER_SCAN_INTERVAL
+    schedule_reminders()
+    due = db.session.query(Reminder.query.filter(
+        Reminder.status == 'pending', Reminder.next_attempt_at <= datetime.utcnow()
+    ).exists()).scalar()
+    busy = db.session.query(Job.query.filter(
+        Job.kind == 'deliver_reminders', Job.status.in_(['queued', 'running'])
+    ).exists()).scalar()
+    if due and not busy:
+        enqueue_job('deliver_reminders')
+
+def reminder_message(title, start_time, location):
+    subject = f'活動提醒：{title}'
+    body = f'時間：{start_time:%Y-%m-%d %H:%M}\n地點：{location}'
+    return subject, body
+
+def send_reminder_batch(transport, message, recipients):
+    try:
+        return transport.send(*message, recipients)
+    except Exception as e:
+        # 整批失敗（連線、驗證錯誤等），全部依退避時間重試
+        return {reminder_id: str(e) or type(e).__name__ for reminder_id, _ in recipients}
+
+@job_handler('deliver_reminders')
+def deliver_reminders_job(job, payload, transports=None):
+    """分批寄送到期的提醒
+
+    以一次查詢取出提醒與活動內容，依活動與管道分批，同時最多 REMINDER_CONCURRENCY 個批次；
+    傳送執行緒不碰資料庫，結果最後以一次 executemany 寫回。失敗的提醒以指數退避重試。
+    """
+    transports = reminder_transports() if transports is None else transports
+    now = datetime.utcnow()
+    rows = db.session.query(
+        Reminder.id, Reminder.channel, Reminder.address, Reminder.attempts,
+        Event.id, Event.title, Event.start_time, Event.location
+    ).join(Event, Event.id == Reminder.event_id).filter(
+        Reminder.status == 'pending', Reminder.next_attempt_at <= now,
+        Reminder.channel.in_(list(transports))
+    ).order_by(Reminder.event_id, Reminder.channel, Reminder.id).all()
+
+    batches = {}
+    attempts = {}
+    for reminder_id, channel, address, attempt, event_id, title, start_time, location in rows:
+        attempts[reminder_id] = attempt
+        key = (event_id, channel)
+        if key not in batches:
+            batches[key] = (reminder_message(title, start_time, location), [])
+        batches[key][1].append((reminder_id, address))
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=REMINDER_CONCURRENCY) as executor:
+        futures = [
+            executor.submit(send_reminder_batch, transports[channel], message, recipients[start:start + REMINDER_BATCH_SIZE])
+            for (_, channel), (message, recipients) in batches.items()
+            for start in range(0, len(recipients), REMINDER_BATCH_SIZE)
+        ]
+        for future in futures:
+            results.update(future.result())
+
+    # 每筆更新的欄位相同，才能以單一 executemany 寫回
+    finished = datetime.utcnow()
+    updates = []
+    for reminder_id, error in results.items():
+        attempt = attempts[reminder_id] + 1
+        sent = error is None
+        updates.append({
+            'id': reminder_id,
+            'status': 'sent' if sent else 'failed' if attempt >= REMINDER_MAX_ATTEMPTS else 'pending',
+            'attempts': attempt,
+            'sent_at': finished if sent else None,
+            'last_error': None if sent else error[:500],
+            'next_attempt_at': finished + timedelta(seconds=REMINDER_RETRY_DELAY * 2 ** (attempt - 1))
+        })
+    if updates:
+        db.session.execute(db.update(Reminder), updates)
+    db.session.commit()
+
+    sent = sum(1 for error in results.values() if error is None)
+    job.message = f'已寄送 {sent} 則提醒，{len(results) - sent} 則失敗'
+    return {'sent': sent, 'failed': len(results) - sent}
+
+@app.route('/admin/jobs')
+def admin_jobs():
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    page, per_page = page_args()
+    rows, pagination = paginate_rows(Job.query.order_by(Job.id.desc()), page, per_page)
+    return jsonify({'success': True, 'jobs': [job_dict(job) for job in rows], 'pagination': pagination})
+
+@app.route('/admin/jobs/<int:job_id>')
+def admin_job_status(job_id):
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '作業不存在'})
+    return jsonify({'success': True, 'job': job_dict(job)})
+
+@app.route('/admin/jobs/<int:job_id>/download')
+def admin_job_download(job_id):
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'success': False, 'message': '權限不足'})
+    
+    job = db.session.get(Job, job_id)
+    result = json.loads(job.result) if job and job.result else {}
+    path = os.path.join(EXPORT_FOLDER, result['file']) if result.get('file') else None
+    if not job or job.status != 'succeeded' or not path or not os.path.exists(path):
+        return jsonify({'success': False, 'message': '檔案尚未產生'})
+    return send_file(path, as_attachment=True, download_name=result['filename'])
+
+# 資料庫遷移
+# create_all 只會建立不存在的資料表，既有資料表的新欄位與索引由這裡的遷移依版本補上。
+# 新增欄位或索引時在模型上宣告，再加一個遷移；新資料庫由 create_all 建立完整結構後直接標記為已套用。
+# 多個程序同時啟動時以檔案鎖逐一執行（見 migration_lock），每個遷移仍應可以重複執行。
+MIGRATIONS = []
+MIGRATION_BATCH_SIZE = 1000
+MIGRATION_BATCH_PAUSE = 0.01  # 秒，批次之間讓出寫入鎖給簽到請求
+
+def migration(version, name):
+    """註冊資料庫遷移"""
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        return func
+    return register
+
+def add_columns(model, *names):
+    """補上既有資料表缺少的欄位；SQLite 的 ADD COLUMN 只改結構描述，不會重寫資料"""
+    table = model.__table__
+    existing = {column['name'] for column in inspect(chapter_engine()).get_columns(table.name)}
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=chapter_engine().dialect)}'
+        if column.server_default is not None:
+            ddl += f' DEFAULT {column.server_default.arg}'
+        db.session.execute(db.text(ddl))
+        print(f"已補上欄位 {table.name}.{column.name}")
+    db.session.commit()
+
+def create_indexes(model, *names):
+    for index in model.__table__.indexes:
+        if index.name in names:
+            index.create(bind=chapter_engine(), checkfirst=True)
+
+def batched_update(model, values, where=None):
+    """依主鍵範圍分批 UPDATE，每批各自提交，不會長時間佔用寫入鎖"""
+    table = model.__table__
+    max_id = db.session.query(db.func.max(table.c.id)).scalar() or 0
+    updated = 0
+    for start in range(0, max_id, MIGRATION_BATCH_SIZE):
+        statement = table.update().where(table.c.id > start, table.c.id <= start + MIGRATION_BATCH_SIZE)
+        if where is not None:
+            statement = statement.where(where)
+        updated += db.session.execute(statement.values(values)).rowcount
+        db.session.commit()
+        time_module.sleep(MIGRATION_BATCH_PAUSE)
+    return updated
+
+def delete_duplicates(model, *names, where=None):
+    """建立唯一索引前分批刪除重複資料，每組保留 ID 最小的一筆"""
+    table = model.__table__
+    other = table.alias()
+    duplicate = db.exists().where(other.c.id < table.c.id, *(other.c[name] == table.c[name] for name in names))
+    candidates = db.select(table.c.id).where(duplicate)
+    if where is not None:
+        candidates = candidates.where(where)
+    deleted = 0
+    while True:
+        ids = db.session.execute(candidates.limit(MIGRATION_BATCH_SIZE)).scalars().all()
+        if not ids:
+            return deleted
+        deleted += db.session.execute(table.delete().where(table.c.id.in_(ids))).rowcount
+        db.session.commit()
+        time_module.sleep(MIGRATION_BATCH_PAUSE)
+
+@migration(1, 'user_profile_columns')
+def migrate_user_profile_columns():
+    add_columns(User, 'line_id', 'avatar', 'position', 'bio')
+
+@migration(2, 'user_permission_flags')
+def migrate_user_permission_flags():
+    # 布林權限欄位已改為位元遮罩（見遷移 8），缺少這些欄位的舊資料庫視為沒有任何權限
+    pass
+
+@migration(3, 'check_in_event_id')
+def migrate_check_in_event_id():
+    add_columns(CheckIn, 'event_id')
+
+@migration(4, 'unique_check_in_and_registration')
+def migrate_unique_check_in_and_registration():
+    delete_duplicates(CheckIn, 'user_id', 'event_id', where=CheckIn.__table__.c.event_id.isnot(None))
+    create_indexes(CheckIn, 'ix_check_in_user_event', 'ix_check_in_check_in_time')
+    delete_duplicates(EventRegistration, 'event_id', 'user_id')
+    create_indexes(EventRegistration, 'ix_event_registration_event_user')
+
+@migration(5, 'event_series_and_counters')
+def migrate_event_series_and_counters():
+    add_columns(Event, 'series_id', 'registered_count', 'attended_count')
+    create_indexes(Event, 'ix_event_start_time', 'ix_event_series_id')
+    # 以既有報名與簽到資料回填人數快取，之後由報名與簽到流程增量維護
+    batched_update(Event, {
+        'registered_count': db.select(db.func.count(EventRegistration.id)).where(
+            EventRegistration.event_id == Event.__table__.c.id, EventRegistration.status == 'registered'
+        ).scalar_subquery(),
+        'attended_count': db.select(db.func.count(CheckIn.id)).where(
+            CheckIn.event_id == Event.__table__.c.id
+        ).scalar_subquery()
     })
 
-# 初始化數據庫和管理員帳號
+@migration(6, 'lookup_indexes')
+def migrate_lookup_indexes():
+    create_indexes(CheckIn, 'ix_check_in_event')
+    create_indexes(EventRegistration, 'ix_event_registration_user')
+
+@migration(7, 'full_text_search')
+def migrate_full_text_search():
+    for name in SEARCH_INDEXES:
+        for statement in search_index_ddl(name):
+            db.session.execute(db.text(statement))
+        # 以既有資料重建索引（單一陳述式，數萬筆約一秒內完成）
+        db.session.execute(db.text(f"INSERT INTO {name}({name}) VALUES ('rebuild')"))
+        db.session.commit()
+
+@migration(8, 'permission_bitmask')
+def migrate_permission_bitmask():
+    add_columns(User, 'permissions')
+    existing = {column['name'] for column in inspect(chapter_engine()).get_columns(User.__tablename__)}
+    legacy = [field for field in PERMISSION_FIELDS if field in existing]
+    if not legacy:
+        return
+    # 以舊的布林欄位回填位元遮罩，之後移除舊欄位
+    batched_update(User, {'permissions': sum(
+        (db.func.coalesce(db.literal_column(field), 0) * PERMISSION_FIELDS[field] for field in legacy), db.literal(0)
+    )})
+    for field in legacy:
+        db.session.execute(db.text(f'ALTER TABLE "{User.__tablename__}" DROP COLUMN {field}'))
+        print(f"已移除欄位 {User.__tablename__}.{field}")
+    db.session.commit()
+
+@contextmanager
+def migration_lock():
+    """以資料庫檔旁的檔案鎖序列化目前分會的建表與遷移
+
+    遷移會分批提交，無法包在單一 BEGIN IMMEDIATE 交易裡；改為整段持有檔案鎖，
+    後到的程序等前一個完成後再重新檢查結構與已套用的版本。
+    """
+    path = chapter_engine().url.database
+    if not path or path == ':memory:':
+        yield
+        return
+    with open(f'{path}.migrate.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def stamp_migrations():
+    db.session.execute(sqlite_insert(SchemaMigration).values([
+        {'version': version, 'name': name} for version, name, _ in MIGRATIONS
+    ]).on_conflict_do_nothing())
+    db.session.commit()
+
+def run_migrations():
+    """依版本順序執行尚未套用的遷移，每個遷移完成後記錄版本；回傳執行的版本"""
+    applied = set(db.session.execute(db.select(SchemaMigration.version)).scalars())
+    executed = []
+    for version, name, func in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version in applied:
+            continue
+        print(f"執行資料庫遷移 {version:03d}_{name}")
+        func()
+        db.session.execute(sqlite_insert(SchemaMigration).values(version=version, name=name).on_conflict_do_nothing())
+        db.session.commit()
+        executed.append(version)
+    return executed
+
+@app.cli.command('migrate')
+def migrate_command():
+    """flask --app app migrate：套用尚未執行的遷移並列出版本狀態"""
+    init_db()
+    for slug in CHAPTERS:
+        with app.app_context(), chapter_context(slug):
+            applied = dict(db.session.execute(db.select(SchemaMigration.version, SchemaMigration.applied_at)).all())
+            print(f"[{CHAPTERS[slug]}]")
+            for version, name, _ in sorted(MIGRATIONS, key=lambda item: item[0]):
+                status = applied[version].strftime('%Y-%m-%d %H:%M:%S') if version in applied else '未套用'
+                print(f"{version:03d}_{name}: {status}")
+
+# 每個分會的資料庫連線建立時附加各自的封存資料庫（這裡只建立 Engine 物件，不會連線）
+# 連線自己提交或回滾後，清除它記下的快取世代
 with app.app_context():
+    for slug in CHAPTERS:
+        engine = chapter_engine(slug)
+        archive_path = app.config.get('CHECKIN_ARCHIVE_PATH') if slug == DEFAULT_CHAPTER else None
+        sa_event.listen(engine, 'connect', functools.partial(attach_checkin_archive, archive_path=archive_path))
+        sa_event.listen(engine, 'commit', forget_generations)
+        sa_event.listen(engine, 'rollback', forget_generations)
+
+db_initialized = False
+db_init_lock = threading.Lock()
+
+# 初始化數據庫和管理員帳號
+def init_db():
+    """為每個分會建立資料表、補上欄位與索引並建立管理員帳號，每個程序只執行一次
+
+    gunicorn 由 master 在 fork 前執行（見 gunicorn.conf.py），匯入 app 本身不會碰資料庫。
+    """
+    global db_initialized
+    with db_init_lock:
+        if db_initialized:
+            return
+        with app.app_context():
+            for slug in CHAPTERS:
+                with chapter_context(slug):
+                    init_chapter_db()
+        db_initialized = True
+
+def init_chapter_db():
+    """建立目前分會的資料表、套用遷移並建立管理員帳號"""
     try:
-        db.create_all()
-        
-        # 創建管理員帳號（如果不存在）
-        admin = User.query.filter_by(username='admin').first()
-        if not admin:
-            admin = User(
-                username='admin',
-                password_hash=generate_password_hash('admin123'),
-                name='001/管理員/系統管理員',
-                email='admin@example.com',
-                is_admin=True,
-                can_add_events=True,
-                can_edit_events=True,
-                can_delete_events=True,
-                can_manage_users=True
-            )
-            db.session.add(admin)
-            db.session.commit()
-            print("管理員帳號已創建")
+        engine = chapter_engine()
+        with migration_lock():
+            # 取得鎖之後才檢查，其他程序可能剛建好資料表或套用完遷移
+            fresh = not inspect(engine).has_table(User.__tablename__)
+            db.metadata.create_all(engine)
+
+            # 新資料庫已是最新結構；舊資料庫的既有資料表由遷移補上欄位與索引
+            if fresh:
+                stamp_migrations()
+            else:
+                run_migrations()
+
+            # 創建管理員帳號（如果不存在）
+            admin = User.query.filter_by(username='admin').first()
+            if not admin:
+                admin = User(
+                    username='admin',
+                    password_hash=generate_password_hash('admin123'),
+                    name='001/管理員/系統管理員',
+                    email='admin@example.com',
+                    is_admin=True,
+                    permissions=ALL_PERMISSIONS
+                )
+                db.session.add(admin)
+                db.session.commit()
+                print(f"{CHAPTERS[current_chapter()]}管理員帳號已創建")
     except Exception as e:
-        print(f"數據庫初始化錯誤：{e}")
+        print(f"{CHAPTERS[current_chapter()]}數據庫初始化錯誤：{e}")
         # 在生產環境中，如果數據庫初始化失敗，我們仍然要讓應用運行
         pass
 
+@app.before_request
+def ensure_db_initialized():
+    # wsgi.py、flask run 等不經過 gunicorn 設定檔的啟動方式，在第一個請求時初始化
+    if not db_initialized:
+        init_db()
+
+def preload():
+    """gunicorn master 在 fork 前呼叫：預先編譯所有模板，並凍結目前的物件
+
+    凍結後垃圾回收不再掃描這些物件，worker 以 copy-on-write 共用的記憶體分頁不會被寫入而複製。
+    """
+    precompile_templates()
+    gc.collect()
+    gc.freeze()
+
+def warm_up():
+    """每個 worker fork 後呼叫：捨棄從 master 繼承的連線池，重新連線並預熱快取"""
+    with app.app_context():
+        for slug in CHAPTERS:
+            chapter_engine(slug).dispose(close=False)
+            with chapter_context(slug):
+                try:
+                    cached_attendance()
+                    cached_kpis()
+                except Exception as e:
+                    print(f"快取預熱失敗：{e}")
+
 if __name__ == '__main__':
     # 開發環境使用 debug 模式，生產環境不使用
     debug_mode = os.environ.get('FLASK_ENV') == 'development'
     port = int(os.environ.get('PORT', 5000))
+    init_db()
+    precompile_templates()
+    # 直接執行時在背景執行緒處理作業；正式環境由 Procfile 的 worker 處理
+    threading.Thread(target=run_worker, daemon=True).start()
     app.run(debug=debug_mode, host='0.0.0.0', port=port) 
\ No newline at end of file
@@ -0,0 +1,183 @@
+"""比較 gunicorn worker 模型在簽到流量下的吞吐量與延遲
+
+在暫存目錄建立測試資料庫（成員與一場進行中的活動），依序以每個 profile
+啟動 gunicorn，模擬多位成員同時透過 /api/checkin/sync 簽到並查詢成員卡片，
+最後列出每秒請求數與 p50 / p99 延遲。
+
+用法：python benchmark.py [--profiles sync,gthread,gevent] [--clients 32] [--duration 10] [--members 200]
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def seed_database(workdir, member_count):
+    """在子程序中匯入 app 建立測試資料，回傳活動 ID 與每位成員的 (ID, session cookie)"""
+    script = f"""
+import json, sys
+from datetime import datetime, timedelta
+sys.path.insert(0, {ROOT!r})
+import app as m
+from werkzeug.security import generate_password_hash
+m.init_db()
+with m.app.app_context():
+    password_hash = generate_password_hash('benchmark')
+    m.db.session.execute(m.db.insert(m.User), [
+        {{'username': f'bench{{i}}', 'password_hash': password_hash, 'name': f'{{i:03d}}/成員{{i}}/測試'}}
+        for i in range({member_count})
+    ])
+    now = datetime.now()
+    event = m.Event(title='壓測例會', location='會議室', start_time=now - timedelta(minutes=10),
+                    end_time=now + timedelta(hours=3), organizer_id=1)
+    m.db.session.add(event)
+    m.db.session.commit()
+    serializer = m.app.session_interface.get_signing_serializer(m.app)
+    members = [(user.id, serializer.dumps({{'user_id': user.id}}))
+               for user in m.User.query.filter(m.User.username.like('bench%'))]
+    print(json.dumps({{'event_id': event.id, 'members': members}}))
+"""
+    env = dict(os.environ, FLASK_ENV='production')
+    output = subprocess.run([sys.executable, '-c', script], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def wait_for_server(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            connection.request('GET', '/health')
+            if connection.getresponse().status == 200:
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def client_loop(port, event_id, members, stop_at, latencies, errors):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    while time.monotonic() < stop_at:
+        user_id, cookie = random.choice(members)
+        headers = {'Cookie': f'session={cookie}'}
+        if random.random() < 0.8:
+            body = json.dumps({'operations': [{
+                'key': uuid.uuid4().hex,
+                'event_id': event_id,
+                'user_id': user_id,
+                'client_time': datetime.utcnow().isoformat() + 'Z'
+            }]})
+            headers['Content-Type'] = 'application/json'
+            method, path = 'POST', '/api/checkin/sync'
+        else:
+            body = None
+            method, path = 'GET', f'/api/user/{user_id}/avatar'
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+            if response.status != 200 or not json.loads(data).get('success'):
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException, ValueError):
+            errors.append('connection')
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_profile(profile, args, workdir, seed):
+    port = args.port
+    env = dict(os.environ, FLASK_ENV='production', GUNICORN_PROFILE=profile, PORT=str(port), JOB_WORKER='external')
+    if args.workers:
+        env['WEB_CONCURRENCY'] = str(args.workers)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+         '--pythonpath', ROOT, 'app:app'],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    try:
+        if not wait_for_server(port):
+            server.terminate()
+            raise RuntimeError(f'{profile} 啟動失敗：{server.stderr.read()[-500:]}')
+
+        latencies, errors = [], []
+        stop_at = time.monotonic() + args.duration
+        threads = [threading.Thread(target=client_loop, args=(port, seed['event_id'], seed['members'], stop_at, latencies, errors))
+                   for _ in range(args.clients)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        return {
+            'profile': profile,
+            'requests': len(latencies),
+            'errors': len(errors),
+            'rps': len(latencies) / elapsed,
+            'p50': percentile(latencies, 0.50) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000
+        }
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', default='sync,gthread,gevent')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--members', type=int, default=200)
+    parser.add_argument('--workers', type=int, help='覆寫 WEB_CONCURRENCY，預設依 profile 而定')
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    results = []
+    for profile in args.profiles.split(','):
+        if profile == 'gevent':
+            try:
+                import gevent  # noqa: F401
+            except ImportError:
+                print('略過 gevent：未安裝 gevent')
+                continue
+        # 每個 profile 使用全新的資料庫，避免前一輪的簽到影響結果
+        workdir = tempfile.mkdtemp(prefix='bni-bench-')
+        try:
+            seed = seed_database(workdir, args.members)
+            print(f'執行 {profile}（{args.clients} 個客戶端，{args.duration:g} 秒）...')
+            results.append(run_profile(profile, args, workdir, seed))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print(f"{'profile':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for result in results:
+        print(f"{result['profile']:<10}{result['requests']:>10}{result['errors']:>8}"
+              f"{result['rps']:>10.1f}{result['p50']:>10.1f}{result['p99']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""快取世代代理：多台主機共用的世代計數器
+
+單機部署時各 worker 直接從 SQLite 的 cache_version 資料表讀取世代，不需要這個程式。
+多台主機時在其中一台啟動，並在所有主機設定 CACHE_BROKER_URL=tcp://<主機>:<埠>，
+寫入資料的 worker 提交後會通知代理，其他主機讀取時即可得知快取已過期。
+
+計數器只存在記憶體中，代理重啟後從 0 開始；回應附帶每次啟動不同的 epoch，
+用戶端會連同世代一起比對，重啟前建立的快取不會被誤用。
+
+協定（每行一個指令）：
+    GET             回傳所有世代的 JSON
+    INCR 範圍 ...   遞增指定範圍並回傳所有世代的 JSON
+
+啟動方式：python cache_broker.py（監聽位址由 CACHE_BROKER_BIND 設定，預設 127.0.0.1:7400）
+"""
+import json
+import os
+import secrets
+import socketserver
+import threading
+
+generations = {}
+epoch = secrets.token_hex(8)
+lock = threading.Lock()
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            command, *scopes = line.decode().split()
+            with lock:
+                if command == 'INCR':
+                    for scope in scopes:
+                        generations[scope] = generations.get(scope, 0) + 1
+                reply = json.dumps({**generations, 'epoch': epoch})
+            self.wfile.write(reply.encode() + b'\n')
+
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if __name__ == "__main__":
+    host, _, port = os.environ.get('CACHE_BROKER_BIND', '127.0.0.1:7400').rpartition(':')
+    with BrokerServer((host, int(port)), BrokerHandler) as server:
+        print(f"快取世代代理已啟動：{host}:{port}")
+        server.serve_forever()
@@ -0,0 +1,94 @@
+"""本機測試用的假 SMTP 與 LINE 服務：收到的提醒只印在終端機，不會真的寄出
+
+啟動方式：python fake_notify.py
+再以下列環境變數啟動 worker.py（或 gunicorn）：
+    SMTP_HOST=127.0.0.1 SMTP_PORT=2525
+    LINE_CHANNEL_TOKEN=test LINE_API_URL=http://127.0.0.1:2526/v2/bot/message/multicast
+
+FAKE_FAIL_RATE（0-1）可讓部分請求隨機失敗，用來觀察重試與退避。
+"""
+import json
+import os
+import random
+import socketserver
+import threading
+from email.header import decode_header, make_header
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAIL_RATE = float(os.environ.get('FAKE_FAIL_RATE', 0))
+
+
+def should_fail():
+    return random.random() < FAIL_RATE
+
+
+class FakeSmtpHandler(socketserver.StreamRequestHandler):
+    """只實作寄信需要的 SMTP 指令"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 fake-smtp ready')
+        recipients = []
+        for raw in self.rfile:
+            command = raw.decode(errors='replace').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self.reply('250 fake-smtp')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                if should_fail():
+                    self.reply('450 模擬暫時失敗')
+                else:
+                    recipients.append(command[8:].strip('<>'))
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                subject = ''
+                for data in self.rfile:
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    if data.lower().startswith(b'subject:'):
+                        subject = str(make_header(decode_header(data[8:].decode(errors='replace').strip())))
+                print(f"[SMTP] {', '.join(recipients)}：{subject}")
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class FakeLineHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if should_fail():
+            self.send_response(500)
+            self.end_headers()
+            return
+        text = payload.get('messages', [{}])[0].get('text', '').split('\n')[0]
+        print(f"[LINE] {len(payload.get('to', []))} 位收件人：{text}")
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if __name__ == "__main__":
+    smtp_port = int(os.environ.get('FAKE_SMTP_PORT', 2525))
+    line_port = int(os.environ.get('FAKE_LINE_PORT', 2526))
+    smtp = FakeSmtpServer(('127.0.0.1', smtp_port), FakeSmtpHandler)
+    threading.Thread(target=smtp.serve_forever, daemon=True).start()
+    print(f"假 SMTP：127.0.0.1:{smtp_port}，假 LINE：http://127.0.0.1:{line_port}")
+    ThreadingHTTPServer(('127.0.0.1', line_port), FakeLineHandler).serve_forever()
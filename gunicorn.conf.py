@@ -0,0 +1,87 @@
+"""Gunicorn 設定：以 GUNICORN_PROFILE 選擇 worker 模型
+
+sync     每個 worker 一次處理一個請求，請求短且 CPU 密集時最單純
+gthread  每個 worker 多執行緒，等待 SQLite 或檔案 I/O 時可以處理其他請求（預設）
+gevent   協程，適合大量慢速連線；需要另外安裝 gevent
+
+其餘參數皆可用環境變數覆寫，各模型的實測數據可用 benchmark.py 比較。
+"""
+import multiprocessing
+import os
+import threading
+
+PROFILES = ('sync', 'gthread', 'gevent')
+
+profile = os.environ.get('GUNICORN_PROFILE', 'gthread')
+if profile not in PROFILES:
+    raise RuntimeError(f"GUNICORN_PROFILE 只能是 {', '.join(PROFILES)}")
+if profile == 'gevent':
+    try:
+        import gevent  # noqa: F401
+    except ImportError:
+        print('未安裝 gevent，改用 gthread')
+        profile = 'gthread'
+
+cpus = multiprocessing.cpu_count()
+default_workers = {'sync': cpus * 2 + 1, 'gthread': cpus + 1, 'gevent': cpus}[profile]
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = profile
+workers = int(os.environ.get('WEB_CONCURRENCY', default_workers))
+threads = int(os.environ.get('GUNICORN_THREADS', 4)) if profile == 'gthread' else 1
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# 定期重啟 worker 回收記憶體，加上隨機量避免所有 worker 同時重啟
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# master 先匯入程式並編譯模板，worker fork 後以 copy-on-write 共用
+preload_app = True
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    """master 啟動時初始化各分會資料庫一次，之後關閉連線，避免 worker 繼承同一條 SQLite 連線"""
+    from app import app, db, init_db
+    init_db()
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def when_ready(server):
+    """fork worker 前編譯所有模板並凍結物件"""
+    from app import preload
+    preload()
+
+
+def post_worker_init(worker):
+    """worker 重新連線並預熱快取
+
+    單機部署（Render、Railway）沒有獨立的 worker 程序，由 web worker 一併處理背景作業；
+    所有 web worker 中只有取得檔案鎖的一個會執行，其他的定期重試（不阻塞，gevent 下也不會卡住 worker）。
+    Procfile 另外啟動 worker.py 時設定 JOB_WORKER=external 關閉。
+    """
+    from app import run_embedded_worker, warm_up
+    warm_up()
+    if os.environ.get('JOB_WORKER', 'embedded') == 'embedded':
+        worker.job_stop = threading.Event()
+        worker.job_thread = threading.Thread(target=run_embedded_worker, args=(worker.job_stop,), daemon=True)
+        worker.job_thread.start()
+
+
+def worker_exit(server, worker):
+    """worker 結束（包含 max_requests 重啟）前讓背景作業迴圈停止領取新作業，並等目前的作業完成
+
+    超過 graceful_timeout 仍未完成的作業會在 JOB_LOCK_TIMEOUT 後由其他 worker 重試。
+    """
+    if getattr(worker, 'job_thread', None):
+        worker.job_stop.set()
+        worker.job_thread.join(graceful_timeout)
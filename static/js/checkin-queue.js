@@ -0,0 +1,98 @@
+// 離線簽到佇列：以 IndexedDB 保存尚未同步的簽到操作，頁面與 Service Worker 共用
+(function (global) {
+    const DB_NAME = 'bni-checkin';
+    const STORE = 'pending';
+    const SYNC_URL = '/api/checkin/sync';
+    const BATCH_SIZE = 200;
+
+    function openDb() {
+        return new Promise(function (resolve, reject) {
+            const request = indexedDB.open(DB_NAME, 1);
+            request.onupgradeneeded = function () {
+                request.result.createObjectStore(STORE, { keyPath: 'key' });
+            };
+            request.onsuccess = function () { resolve(request.result); };
+            request.onerror = function () { reject(request.error); };
+        });
+    }
+
+    function withStore(mode, fn) {
+        return openDb().then(function (db) {
+            return new Promise(function (resolve, reject) {
+                const tx = db.transaction(STORE, mode);
+                const request = fn(tx.objectStore(STORE));
+                tx.oncomplete = function () {
+                    db.close();
+                    resolve(request ? request.result : undefined);
+                };
+                tx.onerror = function () {
+                    db.close();
+                    reject(tx.error);
+                };
+            });
+        });
+    }
+
+    function newKey() {
+        if (global.crypto && global.crypto.randomUUID) {
+            return global.crypto.randomUUID();
+        }
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+    }
+
+    const CheckinQueue = {
+        // 立即記錄一筆簽到，回傳含冪等鍵的操作
+        enqueue: function (op) {
+            const entry = Object.assign({ key: newKey(), client_time: new Date().toISOString() }, op);
+            return withStore('readwrite', function (store) { store.put(entry); }).then(function () {
+                return entry;
+            });
+        },
+
+        pending: function () {
+            return withStore('readonly', function (store) { return store.getAll(); });
+        },
+
+        remove: function (keys) {
+            return withStore('readwrite', function (store) {
+                keys.forEach(function (key) { store.delete(key); });
+            });
+        },
+
+        // 分批送出佇列，伺服器已回覆結果的操作即從佇列移除
+        flush: function () {
+            return CheckinQueue.pending().then(function (ops) {
+                if (!ops.length) {
+                    return [];
+                }
+                const batch = ops.slice(0, BATCH_SIZE);
+                return fetch(SYNC_URL, {
+                    method: 'POST',
+                    credentials: 'same-origin',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ operations: batch })
+                }).then(function (response) {
+                    if (!response.ok) {
+                        throw new Error('HTTP ' + response.status);
+                    }
+                    return response.json();
+                }).then(function (data) {
+                    if (!data.success) {
+                        throw new Error(data.message);
+                    }
+                    const keys = data.results.map(function (result) { return result.key; });
+                    return CheckinQueue.remove(keys).then(function () {
+                        if (ops.length > batch.length) {
+                            return CheckinQueue.flush().then(function (rest) {
+                                return data.results.concat(rest);
+                            });
+                        }
+                        return data.results;
+                    });
+                });
+            });
+        }
+    };
+
+    global.CheckinQueue = CheckinQueue;
+})(self);
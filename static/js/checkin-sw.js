@@ -0,0 +1,40 @@
+// 離線簽到 Service Worker：網路恢復時在背景批次同步簽到佇列
+importScripts('/static/js/checkin-queue.js');
+
+const SYNC_TAG = 'checkin-sync';
+
+self.addEventListener('install', function () {
+    self.skipWaiting();
+});
+
+self.addEventListener('activate', function (event) {
+    event.waitUntil(self.clients.claim());
+});
+
+function broadcast(message) {
+    return self.clients.matchAll({ type: 'window' }).then(function (clients) {
+        clients.forEach(function (client) { client.postMessage(message); });
+    });
+}
+
+function flushQueue() {
+    return CheckinQueue.flush().then(function (results) {
+        if (results.length) {
+            return broadcast({ type: 'checkin-synced', results: results });
+        }
+    });
+}
+
+// Background Sync：同步失敗時瀏覽器會自動退避重試
+self.addEventListener('sync', function (event) {
+    if (event.tag === SYNC_TAG) {
+        event.waitUntil(flushQueue());
+    }
+});
+
+// 不支援 Background Sync 的瀏覽器由頁面主動要求同步
+self.addEventListener('message', function (event) {
+    if (event.data === SYNC_TAG) {
+        event.waitUntil(flushQueue().catch(function () {}));
+    }
+});
@@ -0,0 +1,10 @@
+"""背景作業 worker：從資料庫佇列取出作業執行
+
+啟動方式：python worker.py
+"""
+import os
+
+from app import run_worker
+
+if __name__ == "__main__":
+    run_worker(poll_interval=float(os.environ.get('JOB_POLL_INTERVAL', 2)))
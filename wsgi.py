@@ -1,4 +1,7 @@
-from app import app
+from app import app, precompile_templates
+
+# 啟動時先編譯所有模板
+precompile_templates()
 
 if __name__ == "__main__":
-    app.run() 
\ No newline at end of file
+    app.run()